@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import math
+import os
+import re
+from collections import Counter
+from cache import TTLCache
+from catalog import trigrams
+import context_window
+import metrics
+
+# Cache of complete answers to opening questions ("what movies are playing?", "reviews for Dune"), so repeated questions
+# skip both the planner and the answer completion. Questions are matched on a normalized form first, then on cosine
+# similarity of a cheap local embedding (word and character trigram counts).
+#
+# Each entry remembers the tool calls its answer was based on and a fingerprint of their results. On a hit the calls are
+# replayed (normally from the TMDb cache and showtimes store) and the answer is only served if the data hasn't changed.
+# Entries expire after the shortest TTL of the tools they used, and turns that used a tool with side effects are never cached.
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_MAXSIZE = int(os.getenv("ANSWER_CACHE_MAXSIZE") or 256)
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL") or 3600)
+ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv("ANSWER_CACHE_MIN_SIMILARITY") or 0.88)
+ANSWER_CACHE_REPLAY_TIMEOUT = float(os.getenv("ANSWER_CACHE_REPLAY_TIMEOUT") or 5)
+
+FILLER_WORDS = frozenset("""
+    please pls hi hey hello ok okay so um uh just can could would will you u me i tell show give let know
+    do does is are there any some right now currently thanks thank what whats which for of about on in at to my
+""".split())
+
+def normalize_question(text):
+    words = re.sub(r"[^a-z0-9]+", " ", str(text).lower()).split()
+    return " ".join(word for word in words if word not in FILLER_WORDS)
+
+def embed(normalized):
+    features = Counter(normalized.split())
+    features.update(trigrams(normalized))
+    return features
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(count * b[feature] for feature, count in a.items() if feature in b)
+    if not dot:
+        return 0.0
+    return dot / (math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values())))
+
+def fingerprint(results):
+    digest = hashlib.blake2b(digest_size=16)
+    for result in results:
+        digest.update(repr(result).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def opening_question(message_history):
+    # Only the first user message of a conversation is answered from the cache, since later ones depend on earlier turns
+    user_messages = [message for message in message_history if context_window.message_role(message) == "user"]
+    if len(user_messages) != 1 or context_window.message_role(message_history[-1]) != "user":
+        return None
+    return context_window.message_content(user_messages[0])
+
+async def stream_answer(streamer, answer):
+    for token in re.findall(r"\s*\S+", answer):
+        await streamer.stream_token(token)
+
+class CachedAnswer:
+    __slots__ = ("answer", "calls", "fingerprint", "features", "numbers")
+
+    def __init__(self, answer, calls, fingerprint, features, numbers):
+        self.answer = answer
+        self.calls = calls # ((name, arguments), ...)
+        self.fingerprint = fingerprint
+        self.features = features
+        self.numbers = numbers
+
+class AnswerCache:
+    def __init__(self, registry, maxsize=ANSWER_CACHE_MAXSIZE, ttl=ANSWER_CACHE_TTL, min_similarity=ANSWER_CACHE_MIN_SIMILARITY):
+        self.registry = registry
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self._cache = TTLCache(maxsize) # normalized question -> CachedAnswer
+        self.stale = 0
+        self.near_hits = 0
+
+    def lookup(self, question):
+        # Returns (key, entry) or (None, None)
+        key = normalize_question(question)
+        if not key:
+            return None, None
+        if (entry := self._cache.get(key)) is not None:
+            return key, entry
+
+        # Near-duplicates must mention the same numbers (zip codes, times, sequels) as well as being similar overall
+        features, numbers = embed(key), frozenset(re.findall(r"\d+", key))
+        best_key, best_score = None, self.min_similarity
+        for candidate_key in self._cache.keys():
+            candidate = self._cache.peek(candidate_key)
+            if candidate is None or candidate.numbers != numbers:
+                continue
+            score = cosine(features, candidate.features)
+            if score >= best_score:
+                best_key, best_score = candidate_key, score
+
+        if best_key is None:
+            return None, None
+        self.near_hits += 1
+        return best_key, self._cache.get(best_key)
+
+    async def get(self, question):
+        key, entry = self.lookup(question)
+        if entry is None:
+            metrics.increment("movies_answer_cache_total", result="miss")
+            return None
+
+        # Replay the tool calls the answer was based on; the answer is only reused if their results are unchanged
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*(self.registry.call(name, dict(arguments)) for name, arguments in entry.calls)),
+                timeout=ANSWER_CACHE_REPLAY_TIMEOUT,
+            )
+        except Exception as e:
+            print("Answer cache replay failed: ", e)
+            results = None
+
+        if results is None or fingerprint(results) != entry.fingerprint:
+            self.stale += 1
+            self._cache.invalidate(key)
+            metrics.increment("movies_answer_cache_total", result="stale")
+            return None
+
+        metrics.increment("movies_answer_cache_total", result="hit")
+        return entry.answer
+
+    def store(self, question, answer, recorded_calls):
+        key = normalize_question(question)
+        if not key or not answer:
+            return False
+
+        ttl = self.ttl
+        for call in recorded_calls:
+            tool = self.registry.get(call.name)
+            if call.failed or tool is None or tool.side_effects:
+                return False
+            if tool.ttl is not None:
+                ttl = min(ttl, tool.ttl)
+
+        calls = tuple((call.name, tuple(sorted(call.arguments.items()))) for call in recorded_calls)
+        entry = CachedAnswer(
+            answer,
+            calls,
+            fingerprint(call.result for call in recorded_calls),
+            embed(key),
+            frozenset(re.findall(r"\d+", key)),
+        )
+        self._cache.set(key, entry, ttl)
+        return True
+
+    def stats(self):
+        return {**self._cache.stats(), "near_hits": self.near_hits, "stale": self.stale}
@@ -1,10 +1,23 @@
 from dotenv import load_dotenv
-import chainlit as cl
-import json
-import movie_functions
 
+# Loaded once, before anything else is imported, since the modules below read their settings at import time
 load_dotenv()
 
+import chainlit as cl
+import asyncio
+import os
+import movie_functions
+import context_window
+import metrics
+import upstream_limits
+from stream_coalescer import StreamCoalescer
+from function_plan import CALLBACK, parse_function_plan
+from tool_registry import ToolError, recording_calls
+import answer_cache
+import session_store
+import load_shedding
+from completion_coalescer import create_planner_completion
+
 # Note: If switching to LangSmith, uncomment the following, and replace @observe with @traceable
 # from langsmith.wrappers import wrap_openai
 # from langsmith import traceable
@@ -13,7 +26,18 @@ load_dotenv()
 from langfuse.decorators import observe
 from langfuse.openai import AsyncOpenAI
  
-client = AsyncOpenAI()
+client = AsyncOpenAI(max_retries=0) # Retries are handled by upstream_limits
+
+# Timing histograms and cache gauges are served from Chainlit's server at METRICS_ENDPOINT
+APP_NAME = "app"
+metrics.install_endpoint()
+
+# Complete answers to repeated opening questions, served without calling the model
+answers = answer_cache.AnswerCache(movie_functions.tools)
+metrics.register_stats("answers", answers.stats)
+
+# Conversation histories live in the session store (SESSION_STORE_URL), so any worker can serve any turn
+sessions = session_store.open_session_store()
 
 gen_kwargs = {
     "model": "gpt-4o-mini",
@@ -21,14 +45,14 @@ gen_kwargs = {
     "max_tokens": 500
 }
 
-function_signatures = {
-    "get_now_playing_movies()",
-    "get_showtimes(title, location)",
-    "get_reviews(movie_id)",
-    "buy_ticket(theater, movie, showtime)",
-    "confirm_ticket_purchase(theater, movie, showtime)",
-    "callback()"
-}
+TOOL_CALL_TIMEOUT = float(os.getenv("TOOL_CALL_TIMEOUT") or 15)
+
+# Single-pass mode starts streaming the answer while the planner decides whether a function is needed
+SINGLE_PASS = os.getenv("SINGLE_PASS", "1") == "1"
+
+# Generated from the tool registry in movie_functions; callback() is specific to this app's planner
+function_signatures = [*movie_functions.tools.signatures(), "callback()"]
+FUNCTION_NAMES = (*movie_functions.tools.names(), "callback")
 
 SYSTEM_PROMPT = """
 You are a movie guru. You don't provide awkward qualifiers like, "According to TMDB API..." because no one talks like that and you should speak as if you already know what you know.
@@ -73,40 +97,62 @@ Then, when the required information is provided, the follow-up response should c
 If there is no appropriate function to call, "functions" should be set to an empty array (i.e., []).
 """
 
-function_call_history = [{"role": "system", "content": FUNCTION_SYSTEM_PROMPT}]
+CONVERSATION_PREFIX = "Conversation Between User and Assistant: "
+
+# The planner's own history (function_call_history) is kept in the session store and trimmed to a token budget before each
+# planner call. Only the most recent conversation snapshot is kept, since each snapshot already contains the earlier turns.
+PLANNER_TOKEN_BUDGET = int(os.getenv("PLANNER_TOKEN_BUDGET") or 4000)
+PLANNER_CONVERSATION_TOKEN_BUDGET = int(os.getenv("PLANNER_CONVERSATION_TOKEN_BUDGET") or 2000)
+
+def new_function_call_history():
+    return [{"role": "system", "content": FUNCTION_SYSTEM_PROMPT}]
+
+def append_conversation_snapshot(function_call_history, message_history):
+    # Skip the assistant's own system prompt, and only include the most recent turns that fit in the budget
+    recent_messages = context_window.trim_history(message_history[1:], PLANNER_CONVERSATION_TOKEN_BUDGET, keep_head=0)
+    function_call_history[:] = [
+        message for message in function_call_history
+        if not message["content"].startswith(CONVERSATION_PREFIX)
+    ]
+    function_call_history.append({"role": "system", "content": f"{CONVERSATION_PREFIX}{recent_messages}"})
+    function_call_history[:] = context_window.trim_history(function_call_history, PLANNER_TOKEN_BUDGET)
 
 # Sometimes, 'callback()' will be specified as a parameter of a function response. This is replaced with '[Missing Info]' that lets the assistant know that more information should be requested from the user.
 def parse_missing_info(functions):
     context = ""
-    for func_name, params in functions:
-        for param in params:
-            if "callback()" in param:
-                print(f"Callback detected in parameters for {func_name}; Requesting more information.")
-                # Replace callback() with [Missing Info]
-                params[params.index(param)] = "[Missing Info]"
-                matching_signature = next(filter(lambda s: func_name in s, function_signatures), None)
-                context += f"Following information needed from the user for '{matching_signature}'; {params}\n"
+    for call in functions:
+        if any(param is CALLBACK for param in call.values()):
+            print(f"Callback detected in parameters for {call.name}; Requesting more information.")
+            # Replace callback() with [Missing Info]
+            params = ["[Missing Info]" if param is CALLBACK else param for param in call.args]
+            params += [f"{name}={'[Missing Info]' if param is CALLBACK else param}" for name, param in call.kwargs.items()]
+            matching_signature = next(filter(lambda s: s.startswith(f"{call.name}("), function_signatures), None)
+            context += f"Following information needed from the user for '{matching_signature}'; {params}\n"
     
     return context
 
-def parse_function_signatures(function_signatures):
-    result = []
-    for signature in function_signatures:
-        # Remove the parentheses and split by the first '('
-        func_name, params = signature.split('(', 1)
-        # Remove the closing parenthesis and split by ','
-        params = params.rstrip(')').split(', ')
-        result.append((func_name, params))
-
-    return result
+# Each function call gets its own timeout, and a failure only affects that call's result
+async def call_function_with_timeout(call):
+    func_name = call.name
+    # Never waits past the turn's deadline
+    timeout = load_shedding.timeout(TOOL_CALL_TIMEOUT)
+    try:
+        return await asyncio.wait_for(movie_functions.tools.call(func_name, call.args, call.kwargs), timeout=timeout)
+    except asyncio.TimeoutError:
+        print(f"Function {func_name} timed out after {timeout:.2f}s")
+        return f"{func_name} did not respond in time; let the user know this information is unavailable right now.\n"
+    except ToolError as e:
+        print(f"Invalid call to {func_name}: ", e)
+        return f"{e}\n"
+    except Exception as e:
+        print(f"Function {func_name} failed: ", e)
+        return f"{func_name} failed; let the user know this information is unavailable right now.\n"
 
-async def process_function_call_response(completion):
+async def process_function_call_response(completion, function_call_history):
     function_call_history.append({"role": "assistant", "content": completion.choices[0].message.content})
-    func_json = json.loads(completion.choices[0].message.content)
-    function_signatures = func_json['functions']
-    functions_to_call = parse_function_signatures(function_signatures)
+    functions_to_call = parse_function_plan(completion.choices[0].message.content, FUNCTION_NAMES)
     print("Functions to Call: ", functions_to_call)
-    if functions_to_call.count == 0:
+    if not functions_to_call:
         return None
 
     context = ""
@@ -116,59 +162,37 @@ async def process_function_call_response(completion):
     if context:
         return context
 
-    for func_name, params in functions_to_call:
-        if func_name == "get_now_playing_movies":
-            print("Calling get_now_playing_movies()")
-            context += movie_functions.get_now_playing_movies()
-        elif func_name == "get_showtimes":
-            title = params[0]
-            location = params[1]
-            print("Calling get_showtimes()")
-            print("Title: ", title)
-            print("Location: ", location)
-            context += movie_functions.get_showtimes(title, location)
-        elif func_name == "get_reviews":
-            movie_id = params[0]
-            print("Calling get_reviews()")
-            print("Movie ID: ", movie_id)
-            context += movie_functions.get_reviews(movie_id)
-        elif func_name == "buy_ticket":
-            theater = params[0]
-            movie = params[1]
-            showtime = params[2]
-            print("Calling buy_ticket(); But confirming first.")
-            print("Theater: ", theater)
-            print("Movie: ", movie)
-            print("Showtime: ", showtime)
-            context += f"Ask the user if they really want to buy the ticket for {movie} at {theater} on {showtime}. If they confirm, call confirm_ticket_purchase()."
-        elif func_name == "confirm_ticket_purchase":
-            theater = params[0]
-            movie = params[1]
-            showtime = params[2]
-            print("Calling confirm_ticket_purchase()")
-            print("Theater: ", theater)
-            print("Movie: ", movie)
-            print("Showtime: ", showtime)
-            context += movie_functions.buy_ticket(theater, movie, showtime)
-            context += "Just pretend you bought a ticket." # Without this, the assistant responds that it can't buy tickets.
-        elif func_name == "callback":
-            if context:
-                print("Invoking callback with additional context.")
-                function_call_history.append({"role": "system", "content": f"Here's the requested callback with additional information: {context} \n\n Please use this information to decide the next function(s) to call."})
-                completion = await client.chat.completions.create(messages=function_call_history, **gen_kwargs)
-                context += await process_function_call_response(completion)
-            else:
-                print("No context to provide callback; Ignoring callback request.")
-    
+    # Run every requested function concurrently; the callback (if any) runs afterwards since it needs their results
+    calls = [call for call in functions_to_call if call.name != "callback"]
+    results = await asyncio.gather(*(call_function_with_timeout(call) for call in calls))
+    context += "".join(results)
+
+    if any(call.name == "callback" for call in functions_to_call):
+        if context:
+            print("Invoking callback with additional context.")
+            function_call_history.append({"role": "system", "content": f"Here's the requested callback with additional information: {context} \n\n Please use this information to decide the next function(s) to call."})
+            function_call_history[:] = context_window.trim_history(function_call_history, PLANNER_TOKEN_BUDGET)
+            with metrics.span("planner_completion", app=APP_NAME):
+                completion = await create_planner_completion(client, messages=function_call_history, **gen_kwargs)
+            context += await process_function_call_response(completion, function_call_history) or ""
+        else:
+            print("No context to provide callback; Ignoring callback request.")
+
     return context
 
 async def function_calling(client, message_history):
-    # Append the last message from the user
-    function_call_history.append({"role": "system", "content": f"Conversation Between User and Assistant: {message_history}"})
-    completion = await client.chat.completions.create(messages=function_call_history, **gen_kwargs)
+    function_call_history = cl.user_session.get("function_call_history")
+    if function_call_history is None:
+        function_call_history = new_function_call_history()
+        cl.user_session.set("function_call_history", function_call_history)
+
+    # Replace the previous conversation snapshot with the latest one
+    append_conversation_snapshot(function_call_history, message_history)
+    with metrics.span("planner_completion", app=APP_NAME):
+        completion = await create_planner_completion(client, messages=function_call_history, **gen_kwargs)
     
     try:
-        context = await process_function_call_response(completion)
+        context = await process_function_call_response(completion, function_call_history)
 
         return context
                                 
@@ -179,41 +203,149 @@ async def function_calling(client, message_history):
 
 @observe
 @cl.on_chat_start
-def on_chat_start():    
-    message_history = [{"role": "system", "content": SYSTEM_PROMPT}]
-    cl.user_session.set("message_history", message_history)
+async def on_chat_start():    
+    movie_functions.start_background_tasks()
+    metrics.start_periodic_dump()
+
+# The system prompts aren't stored; only the messages after them are. The planner's history is put in the Chainlit session
+# for function_calling() to use during the turn.
+async def load_session(session_id):
+    message_history, planner_history = await asyncio.gather(
+        sessions.load(session_id, "messages"),
+        sessions.load(session_id, "planner"),
+    )
+    cl.user_session.set("function_call_history", new_function_call_history() + planner_history)
+    return [{"role": "system", "content": SYSTEM_PROMPT}, *message_history]
+
+async def save_session(session_id, message_history, saved):
+    # The conversation only gains messages, so just this turn's are appended. The planner's history is trimmed and its
+    # conversation snapshot replaced every turn, so it's rewritten instead (it's kept under PLANNER_TOKEN_BUDGET).
+    await asyncio.gather(
+        sessions.append(session_id, "messages", message_history[saved:]),
+        sessions.replace(session_id, "planner", cl.user_session.get("function_call_history")[1:]),
+    )
+
+# Single-pass mode: the answer is streamed while the planner is still deciding whether a function is needed. Tokens are
+# buffered until the planner responds; if no function is needed they're flushed to the UI and streaming simply continues,
+# otherwise the speculative stream is abandoned and the planner's context is returned.
+async def stream_while_planning(client, message_history, streamer):
+    planner = asyncio.create_task(function_calling(client, message_history))
+    try:
+        return await stream_until_planned(client, message_history, streamer, planner)
+    finally:
+        # The turn may have been cut short by its deadline
+        planner.cancel()
 
-@observe
-async def generate_response(client, message_history, gen_kwargs):
-    # Start the indicator that the assistant is typing
-    response_message = cl.Message(content="")
-    await response_message.send()
+async def stream_until_planned(client, message_history, streamer, planner):
+    stream = await upstream_limits.create_chat_completion(client, messages=context_window.compact_history(message_history), stream=True, **gen_kwargs)
+
+    buffered_tokens = []
+    planned = False
+    context = None
+    async for part in stream:
+        if part.choices and (token := part.choices[0].delta.content or ""):
+            buffered_tokens.append(token)
+        if not planned and planner.done():
+            planned = True
+            context = planner.result()
+            if context:
+                break
+        if planned and buffered_tokens:
+            await streamer.stream_token("".join(buffered_tokens))
+            buffered_tokens.clear()
+
+    if not planned:
+        context = await planner
+    if context:
+        if close := getattr(stream, "close", None):
+            await close()
+        return context
+
+    if buffered_tokens:
+        await streamer.stream_token("".join(buffered_tokens))
+    return None
+
+async def finish_response(response_message, streamer):
+    await streamer.close()
+    streamer.observe(app=APP_NAME)
+    await response_message.update()
+
+async def respond(client, message_history, streamer):
+    # The speculative answer stream is an extra OpenAI request, so a worker under pressure plans first instead
+    if SINGLE_PASS and not load_shedding.shed("speculative_stream"):
+        context = await stream_while_planning(client, message_history, streamer)
+        if not context:
+            print("No function call")
+            return
+    else:
+        context = await function_calling(client, message_history)
 
-    if context := await function_calling(client, message_history):
+    if context:
         message_history.append({"role": "system", "content": context})
     else:
         print("No function call")
 
-    stream = await client.chat.completions.create(messages=message_history, stream=True, **gen_kwargs)
+    stream = await upstream_limits.create_chat_completion(client, messages=context_window.compact_history(message_history), stream=True, **gen_kwargs)
 
     async for part in stream:
         if token := part.choices[0].delta.content or "":
-            await response_message.stream_token(token)
-    
-    await response_message.update()
+            await streamer.stream_token(token)
+
+@observe
+@metrics.timed("turn", app=APP_NAME)
+async def generate_response(client, message_history, gen_kwargs):
+    # Start the indicator that the assistant is typing
+    response_message = cl.Message(content="")
+    await response_message.send()
+    # Tokens are batched before they're sent to the UI
+    streamer = StreamCoalescer(response_message)
+    # Queued upstream requests are interleaved fairly between sessions
+    upstream_limits.current_session.set(cl.user_session.get("id"))
+
+    question = answer_cache.opening_question(message_history) if answer_cache.ANSWER_CACHE_ENABLED else None
+    try:
+        # Turns are rejected above MAX_CONCURRENT_TURNS, and cut short at the turn deadline
+        with load_shedding.turn():
+            if question and (answer := await answers.get(question)) is not None:
+                print("Answered from the answer cache")
+                await answer_cache.stream_answer(streamer, answer)
+                await finish_response(response_message, streamer)
+                return response_message
+
+            turn_start = len(message_history)
+            with recording_calls() as calls:
+                completed = await load_shedding.run_within_deadline(respond(client, message_history, streamer))
+            if not completed:
+                # Drop any partial context from this turn
+                del message_history[turn_start:]
+    except load_shedding.Overloaded as e:
+        print("Turn rejected: ", e)
+        await streamer.stream_token(load_shedding.OVERLOADED_MESSAGE)
+        await finish_response(response_message, streamer)
+        return response_message
+
+    if not completed:
+        print("Turn deadline exceeded")
+        await load_shedding.finish_cut_short(streamer)
+    await finish_response(response_message, streamer)
+
+    if question and completed:
+        answers.store(question, response_message.content, calls)
 
     return response_message
 
 @cl.on_message
 @observe
 async def on_message(message: cl.Message):
-    message_history = cl.user_session.get("message_history", [])
+    session_id = cl.user_session.get("id")
+    message_history = await load_session(session_id)
+    saved = len(message_history)
     message_history.append({"role": "user", "content": message.content})
     
     response_message = await generate_response(client, message_history, gen_kwargs)
 
     message_history.append({"role": "assistant", "content": response_message.content})
-    cl.user_session.set("message_history", message_history)
+    await save_session(session_id, message_history, saved)
 
 if __name__ == "__main__":
     cl.main()
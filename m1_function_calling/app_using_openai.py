@@ -1,9 +1,23 @@
 from dotenv import load_dotenv
+
+# Loaded once, before anything else is imported, since the modules below read their settings at import time
+load_dotenv()
+
 import chainlit as cl
+import asyncio
 import json
+import os
 import movie_functions
-
-load_dotenv()
+import context_window
+import metrics
+import upstream_limits
+from stream_coalescer import StreamCoalescer
+from tool_registry import ToolError, recording_calls
+import speculation
+import answer_cache
+import session_store
+import load_shedding
+from completion_coalescer import create_planner_completion
 
 # Note: If switching to LangSmith, uncomment the following, and replace @observe with @traceable
 # from langsmith.wrappers import wrap_openai
@@ -13,7 +27,18 @@ load_dotenv()
 from langfuse.decorators import observe
 from langfuse.openai import AsyncOpenAI
  
-client = AsyncOpenAI()
+client = AsyncOpenAI(max_retries=0) # Retries are handled by upstream_limits
+
+# Timing histograms and cache gauges are served from Chainlit's server at METRICS_ENDPOINT
+APP_NAME = "app_using_openai"
+metrics.install_endpoint()
+
+# Complete answers to repeated opening questions, served without calling the model
+answers = answer_cache.AnswerCache(movie_functions.tools)
+metrics.register_stats("answers", answers.stats)
+
+# Conversation histories live in the session store (SESSION_STORE_URL), so any worker can serve any turn
+sessions = session_store.open_session_store()
 
 gen_kwargs = {
     "model": "gpt-4o-mini",
@@ -21,183 +46,64 @@ gen_kwargs = {
     "max_tokens": 500
 }
 
+TOOL_CALL_TIMEOUT = float(os.getenv("TOOL_CALL_TIMEOUT") or 15)
+
+# Single-pass mode streams the first completion with tools enabled instead of making a separate function calling request
+SINGLE_PASS = os.getenv("SINGLE_PASS", "1") == "1"
+MAX_TOOL_ROUNDS = int(os.getenv("MAX_TOOL_ROUNDS") or 3)
+
 SYSTEM_PROMPT = """
 You are a movie guru. You don't provide awkward qualifiers like, "According to TMDB API..." because no one talks like that and you should speak as if you already know what you know.
 """
 
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "get_now_playing_movies",
-            "description": "Get a list of movies that are playing now. Call this whenever you need to know the current movies playing in the theatres, for example when a customer asks 'What movies are currently playing?'",
-            "parameters": {
-                "type": "object",
-                "properties": {},
-                "required": [],
-                "additionalProperties": False
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "get_showtimes",
-            "description": "Get the showtimes for a particular movie playing at a certain location. Call this whenever you need to know the showtimes for a specific movie at a specific location, for example when a customer asks 'What are the showtimes for The Batman in New York?'",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "title": {
-                        "type": "string",
-                        "description": "The title of the movie for which you want to get the showtimes."
-                    },
-                    "location": {
-                        "type": "string",
-                        "description": "The zip code for which you want to get the showtimes."
-                    }
-                },
-                "required": ["title", "location"],
-                "additionalProperties": False
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "get_reviews",
-            "description": "Get the reviews for a particular movie. Call this whenever you need to know the reviews for a specific movie, for example when a customer asks 'What are critics saying about The Batman?'",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "movie_id": {
-                        "type": "string",
-                        "description": "The TMDB movie ID of the movie for which you want to get the reviews."
-                    }
-                },
-                "required": ["movie_id"],
-                "additionalProperties": False
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "buy_ticket",
-            "description": "Buy a ticket for a particular movie at a specific location and time. Call this whenever you need to buy a ticket for a customer, for example when a customer asks an you buy me a ticket for The Batman at AMC Metreon at 7pm?'",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "theater": {
-                        "type": "string",
-                        "description": "The name of the theater where the movie is playing."
-                    },
-                    "movie": {
-                        "type": "string",
-                        "description": "The title of the movie for which you want to buy the ticket."
-                    },
-                    "showtime": {
-                        "type": "string",
-                        "description": "The time at which the movie is playing."
-                    }
-                },
-                "required": ["theater", "movie", "showtime"],
-                "additionalProperties": False
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "confirm_ticket_purchase",
-            "description": "Confirm the purchase of a ticket for a particular movie at a specific location and time. Call this whenever you need to confirm the purchase of a ticket for a customer, for example when a customer asks 'Yes, I want to buy a ticket for The Batman at AMC Metreon at 7pm.'",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "theater": {
-                        "type": "string",
-                        "description": "The name of the theater where the movie is playing."
-                    },
-                    "movie": {
-                        "type": "string",
-                        "description": "The title of the movie for which you want to buy the ticket."
-                    },
-                    "showtime": {
-                        "type": "string",
-                        "description": "The time at which the movie is playing."
-                    }
-                },
-                "required": ["theater", "movie", "showtime"],
-                "additionalProperties": False
-            }
-        }
-    },
-]
+# Generated from the tool registry in movie_functions
+tools = movie_functions.tools.openai_tools()
 
-async def process_function_call_response(completion, message_history):
-    # This code assumes we have already determined that the model generated a function call.
-    tool_call = completion.choices[0].message.tool_calls[0]
-    func_name = tool_call.function.name
-    arguments = json.loads(tool_call.function.arguments)
+# Each tool call gets its own timeout, and a failure only affects that call's result message
+async def run_tool_call(tool_call_id, func_name, raw_arguments):
     print("Function to Call: ", func_name)
+    # Never waits past the turn's deadline
+    timeout = load_shedding.timeout(TOOL_CALL_TIMEOUT)
+    try:
+        arguments = json.loads(raw_arguments or "{}")
+        # A matching speculative call started at the beginning of the turn is used if there is one
+        call = speculation.take(func_name, arguments) or movie_functions.tools.call(func_name, arguments)
+        context = await asyncio.wait_for(call, timeout=timeout)
+        context_label = movie_functions.tools.get(func_name).label
+    except ToolError as e:
+        print(f"Invalid call to {func_name}: ", e)
+        context_label, context = "error", str(e)
+    except asyncio.TimeoutError:
+        print(f"Function {func_name} timed out after {timeout:.2f}s")
+        context_label, context = "error", f"{func_name} did not respond in time."
+    except Exception as e:
+        print(f"Function {func_name} failed: ", e)
+        context_label, context = "error", f"{func_name} failed."
 
-    context = ""
-    function_call_result_message = None
-    if func_name == "get_now_playing_movies":
-        print("Calling get_now_playing_movies()")
-        context = movie_functions.get_now_playing_movies()
-        context_label = "now_playing_movies"
-    elif func_name == "get_showtimes":
-        title = arguments['title']
-        location = arguments['location']
-        print("Calling get_showtimes()")
-        print("Title: ", title)
-        print("Location: ", location)
-        context = movie_functions.get_showtimes(title, location)
-        context_label = "showtimes"
-    elif func_name == "get_reviews":
-        movie_id = arguments['movie_id']
-        print("Calling get_reviews()")
-        print("Movie ID: ", movie_id)
-        context = movie_functions.get_reviews(movie_id)
-        context_label = "reviews"
-    elif func_name == "buy_ticket":
-        theater = arguments['theater']
-        movie = arguments['movie']
-        showtime = arguments['showtime']
-        print("Calling buy_ticket(); But confirming first.")
-        print("Theater: ", theater)
-        print("Movie: ", movie)
-        print("Showtime: ", showtime)
-        context = f"Ask the user if they really want to buy the ticket for {movie} at {theater} on {showtime}. If they confirm, call confirm_ticket_purchase()."
-        context_label = "need_confirmation_to_buy_ticket"
-    elif func_name == "confirm_ticket_purchase":
-        theater = arguments['theater']
-        movie = arguments['movie']
-        showtime = arguments['showtime']
-        print("Calling confirm_ticket_purchase()")
-        print("Theater: ", theater)
-        print("Movie: ", movie)
-        print("Showtime: ", showtime)
-        context = movie_functions.buy_ticket(theater, movie, showtime)
-        context = "Just pretend you bought a ticket." # Without this, the assistant responds that it can't buy tickets.
-        context_label = "ticket_purchase_confirmation"
-    else:
-        print("No function matched the function name.")
+    return {
+        "role": "tool",
+        "content": json.dumps({context_label: context}),
+        "tool_call_id": tool_call_id
+    }
 
-    if context:
-        function_call_result_message = {
-            "role": "tool",
-            "content": json.dumps({context_label: context}),
-            "tool_call_id": completion.choices[0].message.tool_calls[0].id
-        }
-        message_history.append(function_call_result_message)
+async def process_function_call_response(completion, message_history):
+    # This code assumes we have already determined that the model generated a function call.
+    # Every tool call in the turn is dispatched concurrently; results are appended in the order the model requested them.
+    # The API requires a tool message for every tool_call_id, so failed calls still produce one.
+    tool_calls = completion.choices[0].message.tool_calls
+    function_call_result_messages = await asyncio.gather(*(
+        run_tool_call(tool_call.id, tool_call.function.name, tool_call.function.arguments) for tool_call in tool_calls
+    ))
+    message_history.extend(function_call_result_messages)
 
 async def function_calling(client, message_history):
-    completion = await client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=message_history,
-        tools=tools,
-    )
+    with metrics.span("planner_completion", app=APP_NAME):
+        completion = await create_planner_completion(
+            client,
+            model="gpt-4o-mini",
+            messages=context_window.compact_history(message_history),
+            tools=tools,
+        )
 
      # Check if the model has made a tool_call. This is the case either if the "finish_reason" is "tool_calls" or if the "finish_reason" is "stop" and our API request had forced a function call
     if completion.choices[0].finish_reason == "tool_calls":
@@ -219,38 +125,144 @@ async def function_calling(client, message_history):
 
 @observe
 @cl.on_chat_start
-def on_chat_start():    
-    message_history = [{"role": "system", "content": SYSTEM_PROMPT}]
-    cl.user_session.set("message_history", message_history)
+async def on_chat_start():    
+    movie_functions.start_background_tasks()
+    metrics.start_periodic_dump()
+
+# The system prompt isn't stored; only the messages after it are
+async def load_session(session_id):
+    return [{"role": "system", "content": SYSTEM_PROMPT}, *await sessions.load(session_id, "messages")]
+
+async def save_session(session_id, message_history, saved):
+    # The history only gains messages (tool calls and results included), so just this turn's are appended
+    await sessions.append(session_id, "messages", message_history[saved:])
+
+# Streams content tokens to the UI as they arrive, and collects any tool call deltas into complete tool calls
+async def stream_with_tools(client, message_history, streamer, gen_kwargs):
+    stream = await upstream_limits.create_chat_completion(client, messages=context_window.compact_history(message_history), tools=tools, stream=True, **gen_kwargs)
+
+    content = ""
+    tool_calls = {}
+    async for part in stream:
+        if not part.choices:
+            continue
+        delta = part.choices[0].delta
+        if token := delta.content or "":
+            content += token
+            await streamer.stream_token(token)
+        for tool_call_delta in delta.tool_calls or []:
+            tool_call = tool_calls.setdefault(tool_call_delta.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            if tool_call_delta.id:
+                tool_call["id"] = tool_call_delta.id
+            if tool_call_delta.function:
+                tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+
+    return content, [tool_calls[index] for index in sorted(tool_calls)]
+
+# Single-pass mode: the first completion is streamed with tools enabled, so turns that don't need a tool are answered in one
+# round-trip. Tool execution only happens when tool call deltas show up, after which the completion is streamed again.
+async def single_pass_response(client, message_history, streamer, gen_kwargs):
+    for _ in range(MAX_TOOL_ROUNDS):
+        with metrics.span("planner_completion", app=APP_NAME, mode="single_pass"):
+            content, tool_calls = await stream_with_tools(client, message_history, streamer, gen_kwargs)
+        if not tool_calls:
+            return
+
+        print("Model requested a tool call.")
+        message_history.append({"role": "assistant", "content": content or None, "tool_calls": tool_calls})
+        function_call_result_messages = await asyncio.gather(*(
+            run_tool_call(tool_call["id"], tool_call["function"]["name"], tool_call["function"]["arguments"]) for tool_call in tool_calls
+        ))
+        message_history.extend(function_call_result_messages)
+
+    # The model kept asking for tools; answer with the information gathered so far
+    await stream_response(client, message_history, streamer, gen_kwargs)
+
+async def stream_response(client, message_history, streamer, gen_kwargs):
+    stream = await upstream_limits.create_chat_completion(client, messages=context_window.compact_history(message_history), stream=True, **gen_kwargs)
+
+    async for part in stream:
+        if token := part.choices[0].delta.content or "":
+            await streamer.stream_token(token)
+
+def latest_user_message(message_history):
+    if message_history and context_window.message_role(message_history[-1]) == "user":
+        return context_window.message_content(message_history[-1])
+    return None
+
+async def answer(client, message_history, streamer, gen_kwargs):
+    if SINGLE_PASS:
+        await single_pass_response(client, message_history, streamer, gen_kwargs)
+    else:
+        await function_calling(client, message_history)
+        await stream_response(client, message_history, streamer, gen_kwargs)
 
 @observe
+@metrics.timed("turn", app=APP_NAME)
 async def generate_response(client, message_history, gen_kwargs):
     # Start the indicator that the assistant is typing
     response_message = cl.Message(content="")
     await response_message.send()
+    # Tokens are batched before they're sent to the UI
+    streamer = StreamCoalescer(response_message)
+    # Queued upstream requests are interleaved fairly between sessions
+    upstream_limits.current_session.set(cl.user_session.get("id"))
 
-    await function_calling(client, message_history)
+    question = answer_cache.opening_question(message_history) if answer_cache.ANSWER_CACHE_ENABLED else None
+    completed = True
+    try:
+        # Turns are rejected above MAX_CONCURRENT_TURNS, and cut short at the turn deadline
+        with load_shedding.turn():
+            cached_answer = await answers.get(question) if question else None
+            if cached_answer is not None:
+                print("Answered from the answer cache")
+                await answer_cache.stream_answer(streamer, cached_answer)
+            else:
+                # Likely tool calls are started from keyword rules while the model decides which ones it actually needs.
+                # They're extra upstream work, so a worker under pressure skips them.
+                user_message = None if load_shedding.shed("speculation") else latest_user_message(message_history)
+                turn_start = len(message_history)
+                with recording_calls() as calls, speculation.speculating(movie_functions.tools, user_message, movie_functions.movie_catalog):
+                    completed = await load_shedding.run_within_deadline(answer(client, message_history, streamer, gen_kwargs))
+                if not completed:
+                    # Drop any tool calls left without results; the API rejects a history that has them
+                    del message_history[turn_start:]
+                    print("Turn deadline exceeded")
+                    await load_shedding.finish_cut_short(streamer)
+    except load_shedding.Overloaded as e:
+        print("Turn rejected: ", e)
+        cached_answer = None
+        completed = False
+        await streamer.stream_token(load_shedding.OVERLOADED_MESSAGE)
 
-    stream = await client.chat.completions.create(messages=message_history, stream=True, **gen_kwargs)
-
-    async for part in stream:
-        if token := part.choices[0].delta.content or "":
-            await response_message.stream_token(token)
-    
+    await streamer.close()
+    streamer.observe(app=APP_NAME)
     await response_message.update()
 
+    if question and cached_answer is None and completed:
+        answers.store(question, response_message.content, calls)
+
     return response_message
 
 @cl.on_message
 @observe
 async def on_message(message: cl.Message):
-    message_history = cl.user_session.get("message_history", [])
+    session_id = cl.user_session.get("id")
+    message_history = await load_session(session_id)
+    saved = len(message_history)
     message_history.append({"role": "user", "content": message.content})
     
     response_message = await generate_response(client, message_history, gen_kwargs)
 
-    message_history.append({"role": "assistant", "content": response_message.content})
-    cl.user_session.set("message_history", message_history)
+    # In single-pass mode, text streamed before a tool round is already stored with that round's tool calls
+    reply = response_message.content
+    for earlier in message_history[saved + 1:]:
+        if isinstance(earlier, dict) and earlier.get("tool_calls") and earlier.get("content"):
+            reply = reply.removeprefix(earlier["content"])
+
+    message_history.append({"role": "assistant", "content": reply})
+    await save_session(session_id, message_history, saved)
 
 if __name__ == "__main__":
     cl.main()
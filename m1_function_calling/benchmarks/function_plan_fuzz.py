@@ -0,0 +1,131 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from function_plan import CALLBACK, parse_function_plan
+
+# Fuzzes app.py's planner response parser with generated plans in the shapes the model actually produces (titles with
+# commas, parentheses and quotes, unescaped apostrophes, prose or code fences around the JSON, keyword arguments in any
+# order, unquoted arguments), and compares its recovery rate and speed with the original split-based parser.
+#
+#   python benchmarks/function_plan_fuzz.py --cases 20000
+
+FUNCTION_NAMES = ("get_now_playing_movies", "get_showtimes", "get_reviews", "buy_ticket", "confirm_ticket_purchase", "callback")
+
+TITLE_WORDS = ["The", "Batman", "Dune", "Part", "Two", "Joker", "Folie", "à", "Deux", "Wild", "Robot", "Crouching", "Tiger",
+               "Hidden", "Dragon", "Don't", "Worry", "Darling", "Smokin'", "Aces", "Venom", "Last", "Dance", "Beetlejuice", "Smile", "2"]
+TITLE_DECORATIONS = ["", "", ",", ":", " (2024)", " - Director's Cut", "!", " & Friends"]
+LOCATIONS = ["95112", "New York", "San Jose, CA", "02139", "Austin, Texas, United States", "callback()"]
+TIMES = ["7pm", "7:30 PM", "19:45", "10:00am"]
+THEATERS = ["AMC Metreon 16", "Alamo Drafthouse (Mission)", "Regal, Union Square", "Cinemark 20"]
+PARAMETERS = {
+    "get_showtimes": ("title", "location"),
+    "get_reviews": ("movie",),
+    "buy_ticket": ("theater", "movie", "showtime"),
+    "confirm_ticket_purchase": ("theater", "movie", "showtime"),
+}
+
+def random_title(rng):
+    words = rng.sample(TITLE_WORDS, rng.randint(1, 4))
+    return " ".join(words) + rng.choice(TITLE_DECORATIONS)
+
+def render_arg(rng, value):
+    value = str(value)
+    style = rng.random()
+    ambiguous = any(char in value for char in ",()'\"") or value[:1].isdigit() or value != value.strip()
+    if style < 0.6 or (style >= 0.9 and ambiguous):
+        if rng.random() < 0.2:
+            return "'" + value + "'" # The model doesn't always escape apostrophes
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+    if style < 0.9:
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return value # Unquoted; only used when the value is unambiguous
+
+def random_call(rng):
+    name = rng.choice(FUNCTION_NAMES)
+    if name in ("get_now_playing_movies", "callback"):
+        return f"{name}()", (name, (), {})
+    if name == "get_reviews":
+        if rng.random() < 0.5:
+            movie_id = rng.randint(1000, 999999)
+            return f"{name}({movie_id})", (name, (movie_id,), {})
+        args = (random_title(rng),)
+    elif name == "get_showtimes":
+        args = (random_title(rng), rng.choice(LOCATIONS))
+    else:
+        args = (rng.choice(THEATERS), random_title(rng), rng.choice(TIMES))
+
+    args = [CALLBACK if arg == "callback()" else arg for arg in args]
+    rendered = [render_arg(rng, "callback()" if arg is CALLBACK else arg) for arg in args]
+
+    # Some of the trailing arguments as keywords, in any order
+    positional = len(args) if rng.random() < 0.7 else rng.randint(0, len(args) - 1)
+    keywords = [(PARAMETERS[name][index], rendered[index], args[index]) for index in range(positional, len(args))]
+    rng.shuffle(keywords)
+    rendered = rendered[:positional] + [f"{keyword}={value}" for keyword, value, _ in keywords]
+    if rng.random() < 0.05:
+        rendered[-1] += ","
+
+    expected = (name, tuple(args[:positional]), {keyword: arg for keyword, _, arg in keywords})
+    return f"{name}({', '.join(rendered)})", expected
+
+def random_plan(rng):
+    calls = [random_call(rng) for _ in range(rng.randint(0, 3))]
+    body = json.dumps({"functions": [call for call, _ in calls]}, ensure_ascii=False, indent=rng.choice([None, 4]))
+    wrapper = rng.random()
+    if wrapper < 0.7:
+        text = body
+    elif wrapper < 0.85:
+        text = f"```json\n{body}\n```"
+    else:
+        text = f"Sure! Based on the conversation, here is what to call:\n{body}\nLet me know if you need anything else."
+    return text, [expected for _, expected in calls]
+
+# The parser app.py used before function_plan, kept here for comparison
+def legacy_parse(text):
+    result = []
+    for signature in json.loads(text)['functions']:
+        func_name, params = signature.split('(', 1)
+        params = params.rstrip(')').split(', ')
+        result.append((func_name, params))
+    return result
+
+def normalize(calls):
+    # The legacy parser only returns (name, params)
+    return [(call[0], tuple(call[1]), call[2] if len(call) > 2 else {}) for call in calls]
+
+def run(parse, cases):
+    recovered = 0
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # "Skipping unparseable function call" for every failure
+        for text, expected in cases:
+            try:
+                if normalize(parse(text)) == expected:
+                    recovered += 1
+            except Exception:
+                pass
+    elapsed = time.perf_counter() - started
+    return recovered / len(cases), elapsed / len(cases)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cases = [random_plan(rng) for _ in range(args.cases)]
+
+    for label, parse in (("legacy", legacy_parse), ("function_plan", lambda text: parse_function_plan(text, FUNCTION_NAMES))):
+        rate, per_call = run(parse, cases)
+        print(f"{label:>14}: recovered {rate:7.2%} of {len(cases)} plans, {per_call * 1e6:6.1f} µs per plan")
+
+if __name__ == "__main__":
+    main()
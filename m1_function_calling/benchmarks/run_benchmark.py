@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import importlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCHMARK_DIR)
+APPS = ("app", "app_using_openai")
+BENCHMARK_CACHE = os.path.join(BENCHMARK_DIR, ".cache", "tool_cache.sqlite3")
+
+# Replays scripted multi-turn conversations through generate_response() in app.py and app_using_openai.py at a configurable
+# concurrency, against the local stub servers in stub_servers.py, and reports turn latency, time-to-first-token, tokens per
+# turn and RSS. Each app runs in its own process with the apps' default configuration, including the persistent cache (in a
+# file of its own, so stub responses never end up in the app's cache), so a second run starts warm. --no-persistent-cache
+# makes every run start cold.
+#
+#   python benchmarks/run_benchmark.py --sessions 100 --concurrency 100
+#   python benchmarks/run_benchmark.py --app app_using_openai --conversation showtimes_follow_up --openai-ttft 1.0
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return None
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def stub_request(port, path, method="GET"):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read())
+
+def start_stub_server(port, stub_args):
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "stub_servers.py"), "--port", str(port), *stub_args])
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            stub_request(port, "/stats")
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Stub server didn't start")
+
+def configure_environment(port, persistent_cache=BENCHMARK_CACHE, session_store=""):
+    # Must run before the apps are imported; load_dotenv() doesn't override variables that are already set
+    os.environ.update({
+        "TMDB_API_BASE_URL": f"http://127.0.0.1:{port}/tmdb/3",
+        "SERP_API_BASE_URL": f"http://127.0.0.1:{port}/serpapi",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{port}/openai/v1",
+        "OPENAI_API_KEY": "stub",
+        "TMDB_API_ACCESS_TOKEN": "stub",
+        "SERP_API_KEY": "stub",
+        # There's no Chainlit server to serve /metrics from
+        "METRICS_ENDPOINT": "",
+        # "" disables the persistent cache
+        "PERSISTENT_CACHE_PATH": persistent_cache,
+        # Histories stay in memory unless a session store URL is given
+        "SESSION_STORE_URL": session_store,
+    })
+
+# Stand-ins for the parts of Chainlit that generate_response() touches, so it can be driven outside a Chainlit server
+
+current_session = contextvars.ContextVar("current_session")
+
+class BenchmarkUserSession:
+    def get(self, key, default=None):
+        return current_session.get().get(key, default)
+
+    def set(self, key, value):
+        current_session.get()[key] = value
+
+class BenchmarkMessage:
+    def __init__(self, content="", **kwargs):
+        self.content = content
+        self.first_token_at = None
+        self.chunks = 0
+
+    async def send(self):
+        return self
+
+    async def stream_token(self, token, is_sequence=False):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.chunks += 1
+        self.content += token
+
+    async def update(self):
+        return True
+
+def install_chainlit_stand_ins():
+    import chainlit as cl
+    cl.Message = BenchmarkMessage
+    cl.user_session = BenchmarkUserSession()
+
+class Recorder:
+    def __init__(self):
+        self.turn_latencies = []
+        self.ttfts = []
+        self.chunks = []
+        self.errors = 0
+
+async def run_session(app, script, recorder, session_id):
+    current_session.set({"id": session_id})
+    await app.on_chat_start()
+
+    for text in script:
+        # Same load/save around each turn as on_message(), so the session store is part of what's measured
+        message_history = await app.load_session(session_id)
+        saved = len(message_history)
+        message_history.append({"role": "user", "content": text})
+
+        started = time.perf_counter()
+        try:
+            response_message = await app.generate_response(app.client, message_history, app.gen_kwargs)
+        except Exception as e:
+            recorder.errors += 1
+            print("Turn failed: ", e, file=sys.__stderr__)
+            continue
+        recorder.turn_latencies.append(time.perf_counter() - started)
+        if response_message.first_token_at is not None:
+            recorder.ttfts.append(response_message.first_token_at - started)
+        recorder.chunks.append(response_message.chunks)
+
+        message_history.append({"role": "assistant", "content": response_message.content})
+        await app.save_session(session_id, message_history, saved)
+
+async def run_sessions(app, scripts, sessions, concurrency, recorder):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index):
+        async with semaphore:
+            await run_session(app, scripts[index % len(scripts)], recorder, f"session-{index}")
+
+    await asyncio.gather(*(run(index) for index in range(sessions)))
+
+def run_app(args):
+    # Runs in the worker process for a single app
+    configure_environment(args.port, args.persistent_cache, args.session_store)
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    install_chainlit_stand_ins()
+    app = importlib.import_module(args.app)
+
+    with open(os.path.join(BENCHMARK_DIR, "conversations.json")) as f:
+        conversations = json.load(f)
+    scripts = [conversations[args.conversation]] if args.conversation else list(conversations.values())
+
+    stub_request(args.port, "/stats/reset", method="POST")
+    recorder = Recorder()
+    rss_before = current_rss_mb()
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if args.quiet else sys.stdout):
+        asyncio.run(run_sessions(app, scripts, args.sessions, args.concurrency, recorder))
+    elapsed = time.perf_counter() - started
+    upstream = stub_request(args.port, "/stats")
+
+    turns = len(recorder.turn_latencies) or 1
+    openai = upstream.get("openai", {})
+    return {
+        "app": args.app,
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "turns": len(recorder.turn_latencies),
+        "errors": recorder.errors,
+        "elapsed_s": elapsed,
+        "turn_latency_s": {f"p{p}": percentile(recorder.turn_latencies, p) for p in (50, 95, 99)},
+        "ttft_s": {f"p{p}": percentile(recorder.ttfts, p) for p in (50, 95, 99)},
+        "ui_chunks_per_turn": sum(recorder.chunks) / turns,
+        "prompt_tokens_per_turn": openai.get("prompt_tokens", 0) / turns,
+        "completion_tokens_per_turn": openai.get("completion_tokens", 0) / turns,
+        "upstream_requests_per_turn": {name: counters["requests"] / turns for name, counters in upstream.items()},
+        "rss_mb": {"before": rss_before, "after": current_rss_mb(), "peak": peak_rss_mb()},
+    }
+
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:7.0f}ms"
+
+def print_report(result):
+    latency, ttft, rss = result["turn_latency_s"], result["ttft_s"], result["rss_mb"]
+    print(f"\n== {result['app']}: {result['sessions']} sessions @ concurrency {result['concurrency']}, "
+          f"{result['turns']} turns ({result['errors']} errors) in {result['elapsed_s']:.1f}s")
+    print(f"  turn latency  p50 {format_seconds(latency['p50'])}  p95 {format_seconds(latency['p95'])}  p99 {format_seconds(latency['p99'])}")
+    print(f"  TTFT          p50 {format_seconds(ttft['p50'])}  p95 {format_seconds(ttft['p95'])}  p99 {format_seconds(ttft['p99'])}")
+    print(f"  tokens/turn   prompt {result['prompt_tokens_per_turn']:.0f}  completion {result['completion_tokens_per_turn']:.0f}"
+          f"  (UI chunks/turn {result['ui_chunks_per_turn']:.1f})")
+    print("  upstream/turn " + "  ".join(f"{name} {value:.2f}" for name, value in sorted(result["upstream_requests_per_turn"].items())))
+    print(f"  RSS           peak {rss['peak']:.0f}MB" + (f"  after {rss['after']:.0f}MB" if rss["after"] else ""))
+
+def main():
+    sys.path.insert(0, BENCHMARK_DIR)
+    import stub_servers
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", choices=APPS, help="Only benchmark this app (default: both)")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--conversation", help="Only replay this conversation from conversations.json (default: all)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--persistent-cache", default=BENCHMARK_CACHE, help="Persistent cache file shared by the runs (default: benchmarks/.cache/tool_cache.sqlite3)")
+    parser.add_argument("--no-persistent-cache", dest="persistent_cache", action="store_const", const="",
+                        help="Disable the persistent cache, so every run starts cold")
+    parser.add_argument("--session-store", default="", help="SESSION_STORE_URL for the apps, e.g. sqlite:////tmp/bench_sessions.sqlite3 (default: memory)")
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="Show the apps' own output")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    stub_servers.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_app(args)))
+        return
+
+    stub_args = []
+    for key in ("tmdb_latency", "serpapi_latency", "openai_ttft", "openai_token_interval", "answer_tokens", "now_playing_pages", "reviews_per_movie", "throttle_rate"):
+        stub_args += [f"--{key.replace('_', '-')}", str(getattr(args, key))]
+
+    server = start_stub_server(args.port, stub_args)
+    results = []
+    try:
+        for app in ([args.app] if args.app else APPS):
+            worker_args = [sys.executable, os.path.abspath(__file__), "--worker", "--app", app, "--port", str(args.port),
+                           "--sessions", str(args.sessions), "--concurrency", str(args.concurrency)]
+            if args.conversation:
+                worker_args += ["--conversation", args.conversation]
+            worker_args += ["--persistent-cache", args.persistent_cache]
+            if args.session_store:
+                worker_args += ["--session-store", args.session_store]
+            if not args.quiet:
+                worker_args.append("--verbose")
+            output = subprocess.run(worker_args, check=True, stdout=subprocess.PIPE, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print_report(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+import uvicorn
+
+# Local stand-ins for the upstream APIs used by the apps, each with configurable latency:
+#   /tmdb/3/...                    TMDb now_playing, reviews and search
+#   /serpapi/search.json           SerpAPI Google search with showtimes
+#   /openai/v1/chat/completions    OpenAI-compatible chat completions (streaming and non-streaming, with tool calls)
+#   /stats                         request and token counters per upstream (POST /stats/reset to clear them)
+#
+# --throttle-rate answers a fraction of requests with a 429 and Retry-After, to exercise the apps' backoff.
+#
+# Point the apps at it with:
+#   TMDB_API_BASE_URL=http://127.0.0.1:8765/tmdb/3
+#   SERP_API_BASE_URL=http://127.0.0.1:8765/serpapi
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/openai/v1
+#
+#   python benchmarks/stub_servers.py --port 8765 --tmdb-latency 0.08 --openai-ttft 0.3
+
+TITLES = [
+    "The Wild Robot", "Joker: Folie à Deux", "Beetlejuice Beetlejuice", "Transformers One", "Smile 2", "Venom: The Last Dance",
+    "Terrifier 3", "Speak No Evil", "Deadpool & Wolverine", "It Ends with Us", "Alien: Romulus", "Megalopolis",
+    "Saturday Night", "Piece by Piece", "We Live in Time", "The Substance", "Never Let Go", "Lonely Planet",
+    "Caddo Lake", "Salem's Lot",
+]
+THEATERS = ["AMC Metreon 16", "Alamo Drafthouse New Mission", "Regal Stonestown", "Century San Francisco Centre", "CGV San Jose"]
+DAYS = ["TodayOct 17", "FriOct 18", "SatOct 19"]
+REVIEW_SENTENCE = "The performances are strong and the pacing mostly works, though the third act leans on familiar beats. "
+
+config = argparse.Namespace(
+    tmdb_latency=0.08,
+    serpapi_latency=0.8,
+    openai_ttft=0.3,
+    openai_token_interval=0.01,
+    answer_tokens=60,
+    now_playing_pages=1,
+    reviews_per_movie=8,
+    throttle_rate=0.0,
+)
+
+stats = {}
+
+def count(upstream, **counters):
+    entry = stats.setdefault(upstream, {"requests": 0, "throttled": 0, "prompt_tokens": 0, "completion_tokens": 0})
+    entry["requests"] += 1
+    for key, value in counters.items():
+        entry[key] += value
+
+def throttled(upstream):
+    # Simulates rate limiting: returns a 429 with Retry-After for a fraction of requests
+    if random.random() >= config.throttle_rate:
+        return None
+    count(upstream, throttled=1)
+    return JSONResponse({"error": "rate limited"}, status_code=429, headers={"Retry-After": "1"})
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def movie(index):
+    return {
+        "id": 1000 + index,
+        "title": TITLES[index % len(TITLES)] + ("" if index < len(TITLES) else f" {index // len(TITLES) + 1}"),
+        "release_date": f"2024-{9 + index % 2:02d}-{1 + index % 28:02d}",
+        "overview": f"Overview for movie {index}. " * 12,
+    }
+
+# TMDb
+
+async def now_playing(request: Request):
+    await asyncio.sleep(config.tmdb_latency)
+    if response := throttled("tmdb"):
+        return response
+    count("tmdb")
+    page = int(request.query_params.get("page", 1))
+    results = [movie((page - 1) * 20 + i) for i in range(20)] if page <= config.now_playing_pages else []
+    return JSONResponse({"page": page, "results": results, "total_pages": config.now_playing_pages, "total_results": config.now_playing_pages * 20})
+
+async def reviews(request: Request):
+    await asyncio.sleep(config.tmdb_latency)
+    if response := throttled("tmdb"):
+        return response
+    count("tmdb")
+    movie_id = int(request.path_params["movie_id"])
+    page = int(request.query_params.get("page", 1))
+    results = [
+        {
+            "author": f"critic{i}",
+            "author_details": {"rating": (movie_id + i) % 10 + 1},
+            "content": REVIEW_SENTENCE * (5 + i % 10),
+            "created_at": f"2024-10-{1 + i % 28:02d}T12:00:00.000Z",
+            "id": f"{movie_id}-{i}",
+            "url": f"https://www.themoviedb.org/review/{movie_id}-{i}",
+        }
+        for i in range(config.reviews_per_movie)
+    ] if page == 1 else []
+    return JSONResponse({"id": movie_id, "page": page, "results": results, "total_pages": 1, "total_results": len(results)})
+
+async def search(request: Request):
+    await asyncio.sleep(config.tmdb_latency)
+    if response := throttled("tmdb"):
+        return response
+    count("tmdb")
+    query = request.query_params.get("query", "").lower()
+    results = [movie(i) for i in range(len(TITLES)) if query and query in TITLES[i].lower()]
+    return JSONResponse({"page": 1, "results": results, "total_pages": 1, "total_results": len(results)})
+
+# SerpAPI
+
+async def serpapi_search(request: Request):
+    await asyncio.sleep(config.serpapi_latency)
+    if response := throttled("serpapi"):
+        return response
+    count("serpapi")
+    showtimes = [
+        {
+            "day": day,
+            "theaters": [
+                {"name": theater, "showing": [{"time": ["1:00pm", "4:15pm", "7:30pm", "10:05pm"], "type": "Standard"}]}
+                for theater in THEATERS
+            ],
+        }
+        for day in DAYS
+    ]
+    return JSONResponse({"search_metadata": {"status": "Success"}, "showtimes": showtimes})
+
+# OpenAI
+
+def message_text(message):
+    return message.get("content") or ""
+
+def guess_title(text):
+    lowered = text.lower()
+    for title in TITLES:
+        if title.lower().split(":")[0] in lowered:
+            return title
+    return TITLES[0]
+
+def planned_calls(text):
+    # Cheap keyword "intent model" so scripted conversations exercise the tool paths
+    lowered = text.lower()
+    calls = []
+    if "playing" in lowered:
+        calls.append(("get_now_playing_movies", {}))
+    if "showtime" in lowered or "later show" in lowered or "another theater" in lowered:
+        calls.append(("get_showtimes", {"title": guess_title(text), "location": "95112"}))
+    if "review" in lowered or "critics" in lowered:
+        calls.append(("get_reviews", {"movie": guess_title(text)}))
+    if "buy" in lowered:
+        calls.append(("buy_ticket", {"theater": THEATERS[0], "movie": guess_title(text), "showtime": "7:30pm"}))
+    if lowered.strip().startswith("yes"):
+        calls.append(("confirm_ticket_purchase", {"theater": THEATERS[0], "movie": guess_title(text), "showtime": "7:30pm"}))
+    return calls
+
+def last_user_text(messages):
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message_text(message)
+    return ""
+
+def plan_for_app_py(messages):
+    # app.py's planner replies with {"functions": [...]}; the conversation arrives as a system message snapshot
+    last = message_text(messages[-1])
+    if last.startswith("Here's the requested callback"):
+        return {"functions": []}
+    user_turns = re.findall(r"'role': 'user', 'content': (?:'|\")(.*?)(?:'|\")\}", last)
+    text = user_turns[-1] if user_turns else last
+    functions = []
+    for name, arguments in planned_calls(text):
+        args = ", ".join(repr(value) for value in arguments.values())
+        functions.append(f"{name}({args})")
+    return {"functions": functions}
+
+def completion_plan(body):
+    # Returns (content, tool_calls)
+    messages = body.get("messages", [])
+    if messages and "respond with one of the following function names" in message_text(messages[0]):
+        return json.dumps(plan_for_app_py(messages)), []
+
+    if body.get("tools") and messages and messages[-1].get("role") == "user":
+        calls = planned_calls(last_user_text(messages))
+        if calls:
+            return None, [
+                {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+                for name, arguments in calls
+            ]
+
+    words = ("Here", "is", "a", "stubbed", "answer", "about", "the", "movies", "you", "asked", "about.")
+    return " ".join(words[i % len(words)] for i in range(config.answer_tokens)), []
+
+def chunk(completion_id, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "stub",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+async def chat_completions(request: Request):
+    body = await request.json()
+    if response := throttled("openai"):
+        return response
+    prompt_tokens = estimate_tokens(json.dumps(body.get("messages", []))) + estimate_tokens(json.dumps(body.get("tools") or []))
+    content, tool_calls = completion_plan(body)
+    completion_tokens = estimate_tokens(content or json.dumps(tool_calls))
+    count("openai", prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    finish_reason = "tool_calls" if tool_calls else "stop"
+
+    if not body.get("stream"):
+        await asyncio.sleep(config.openai_ttft + config.openai_token_interval * completion_tokens)
+        message = {"role": "assistant", "content": content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "stub",
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    async def events():
+        await asyncio.sleep(config.openai_ttft)
+        yield f"data: {json.dumps(chunk(completion_id, {'role': 'assistant', 'content': ''}))}\n\n"
+        if tool_calls:
+            for index, tool_call in enumerate(tool_calls):
+                delta = {"tool_calls": [{"index": index, **tool_call}]}
+                yield f"data: {json.dumps(chunk(completion_id, delta))}\n\n"
+        else:
+            for i, word in enumerate(content.split(" ")):
+                await asyncio.sleep(config.openai_token_interval)
+                yield f"data: {json.dumps(chunk(completion_id, {'content': word if i == 0 else ' ' + word}))}\n\n"
+        yield f"data: {json.dumps(chunk(completion_id, {}, finish_reason))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+async def get_stats(request: Request):
+    return JSONResponse(stats)
+
+async def reset_stats(request: Request):
+    stats.clear()
+    return JSONResponse({})
+
+app = Starlette(routes=[
+    Route("/tmdb/3/movie/now_playing", now_playing),
+    Route("/tmdb/3/movie/{movie_id:int}/reviews", reviews),
+    Route("/tmdb/3/search/movie", search),
+    Route("/serpapi/search.json", serpapi_search),
+    Route("/openai/v1/chat/completions", chat_completions, methods=["POST"]),
+    Route("/stats", get_stats),
+    Route("/stats/reset", reset_stats, methods=["POST"]),
+])
+
+def add_arguments(parser):
+    parser.add_argument("--tmdb-latency", type=float, default=config.tmdb_latency, help="Seconds per TMDb request")
+    parser.add_argument("--serpapi-latency", type=float, default=config.serpapi_latency, help="Seconds per SerpAPI search")
+    parser.add_argument("--openai-ttft", type=float, default=config.openai_ttft, help="Seconds before the first token")
+    parser.add_argument("--openai-token-interval", type=float, default=config.openai_token_interval, help="Seconds between streamed tokens")
+    parser.add_argument("--answer-tokens", type=int, default=config.answer_tokens, help="Words per streamed answer")
+    parser.add_argument("--now-playing-pages", type=int, default=config.now_playing_pages, help="Pages of now_playing results")
+    parser.add_argument("--reviews-per-movie", type=int, default=config.reviews_per_movie, help="Reviews returned per movie")
+    parser.add_argument("--throttle-rate", type=float, default=config.throttle_rate, help="Fraction of requests answered with a 429")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        setattr(config, key, value)
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
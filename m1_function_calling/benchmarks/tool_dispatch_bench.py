@@ -0,0 +1,57 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tool_registry import Parameter, ToolRegistry
+
+# Measures the per-call overhead of dispatching through ToolRegistry.call() (lookup, argument validation and conversion)
+# compared with calling the handler directly.
+#
+#   python benchmarks/tool_dispatch_bench.py --calls 200000
+
+registry = ToolRegistry()
+
+@registry.register(
+    "get_showtimes",
+    "Benchmark stand-in for get_showtimes.",
+    parameters=[
+        Parameter("title", "Title"),
+        Parameter("location", "Location"),
+        Parameter("theater", "Theater", required=False),
+    ],
+)
+async def get_showtimes(title, location, theater=None):
+    return title
+
+async def measure(calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        await get_showtimes(title="The Batman", location="95112")
+    direct = (time.perf_counter() - started) / calls
+
+    started = time.perf_counter()
+    for _ in range(calls):
+        await registry.call("get_showtimes", {"title": "The Batman", "location": "95112"})
+    keyword = (time.perf_counter() - started) / calls
+
+    started = time.perf_counter()
+    for _ in range(calls):
+        await registry.call("get_showtimes", ("The Batman", "95112"))
+    positional = (time.perf_counter() - started) / calls
+
+    print(f"        direct call: {direct * 1e6:6.2f} µs")
+    print(f"  registry (kwargs): {keyword * 1e6:6.2f} µs ({(keyword - direct) * 1e6:+.2f} µs overhead)")
+    print(f"registry (positional): {positional * 1e6:6.2f} µs ({(positional - direct) * 1e6:+.2f} µs overhead)")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.run(measure(args.calls))
+
+if __name__ == "__main__":
+    main()
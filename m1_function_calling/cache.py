@@ -0,0 +1,148 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# Bounded in-process cache with per-entry TTLs and LRU eviction.
+# get_or_fetch() coalesces concurrent misses for the same key, so only one upstream call is made while the others wait on it.
+# An optional second tier (disk_cache.PersistentTier) is checked before fetching and written after, and can warm the cache.
+# With a stale_ttl, expired entries are kept that much longer so get_or_fetch() can fall back to them when a fetch fails,
+# or serve them straight away when asked to (e.g. under load).
+
+_MISSING = object()
+
+class TTLCache:
+    def __init__(self, maxsize=256, l2=None, stale_ttl=0):
+        self.maxsize = maxsize
+        self.l2 = l2
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._inflight = {} # key -> asyncio.Task
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return list(self._entries)
+
+    def peek(self, key, default=None):
+        # Like get(), but doesn't count as a hit or miss or refresh the entry's LRU position
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        now = time.monotonic()
+        if expires_at <= now:
+            if expires_at + self.stale_ttl <= now:
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def remaining(self, key):
+        # Seconds until the entry expires, or None if there's no fresh entry. Like peek(), doesn't count as a hit or miss.
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[0] - time.monotonic()
+
+    def get_stale(self, key, default=None):
+        # The entry even if it has expired, as long as it's within stale_ttl of its expiry
+        entry = self._entries.get(key)
+        if entry is None or entry[0] + self.stale_ttl <= time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_fetch(self, key, fetch, ttl, serve_stale=False):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        stale = self.get_stale(key, _MISSING)
+        if serve_stale and stale is not _MISSING:
+            self.stale_hits += 1
+            return stale
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._fetch_and_store(key, fetch, ttl))
+            self._inflight[key] = task
+
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if stale is _MISSING:
+                raise
+            self.stale_hits += 1
+            return stale
+
+    async def _fetch_and_store(self, key, fetch, ttl):
+        try:
+            if self.l2 is not None and (entry := self.l2.get(key)) is not None:
+                value, remaining = entry
+                self.set(key, value, remaining)
+                return value
+
+            value = await fetch()
+            # A ttl of 0 only coalesces concurrent fetches; nothing is kept afterwards
+            if ttl > 0:
+                self.set(key, value, ttl)
+                if self.l2 is not None:
+                    self.l2.set(key, value, ttl)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def warm(self):
+        # Loads unexpired entries from the second tier, e.g. at startup; returns how many were loaded
+        if self.l2 is None:
+            return 0
+        entries = self.l2.load(self.maxsize)
+        for key, value, remaining in entries:
+            self.set(key, value, remaining)
+        return len(entries)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "coalesced": self.coalesced,
+            "stale_hits": self.stale_hits,
+            "inflight": len(self._inflight),
+        }
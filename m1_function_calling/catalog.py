@@ -0,0 +1,132 @@
+import re
+import unicodedata
+
+# Local in-memory index of movies seen in TMDb results, for resolving a title to a TMDb ID without another round-trip.
+# Lookups try the normalized title first, then fall back to trigram similarity for misspellings. Articles are part of the
+# title ("Batman" and "The Batman" are different films), so a query that only differs by one is a fuzzy match. A fuzzy
+# match is only trusted when it's close (min_score) and clearly ahead of the next best title (min_margin); "The Batman"
+# must not resolve to "Batman Begins" just because that's the only Batman the catalog has seen, so anything less returns
+# None and the caller searches TMDb instead.
+
+def normalize_title(title):
+    title = unicodedata.normalize("NFKD", str(title)).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", " ", title.lower()).strip()
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class MovieCatalog:
+    def __init__(self, maxsize=5000, min_score=0.8, min_margin=0.1):
+        self.maxsize = maxsize
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self._by_id = {} # movie id -> Movie, in insertion order
+        self._by_title = {} # normalized title -> movie id
+        self._trigrams = {} # movie id -> trigram set
+        self._index = {} # trigram -> set of movie ids
+        self._phrases = {} # normalized title, or the part before a subtitle colon -> movie id, for find_in_text()
+        self._max_phrase_words = 1
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, movie_id):
+        return movie_id in self._by_id
+
+    def add(self, movies):
+        for movie in movies:
+            if movie.id is None:
+                continue
+            self.remove(movie.id)
+
+            key = normalize_title(movie.title)
+            grams = trigrams(key)
+            self._by_id[movie.id] = movie
+            self._by_title[key] = movie.id
+            self._trigrams[movie.id] = grams
+            for gram in grams:
+                self._index.setdefault(gram, set()).add(movie.id)
+
+            # A full title takes precedence over another movie's title before its subtitle
+            short = normalize_title(str(movie.title).split(":")[0])
+            if short and short != key:
+                self._phrases.setdefault(short, movie.id)
+            self._phrases[key] = movie.id
+            self._max_phrase_words = max(self._max_phrase_words, key.count(" ") + 1)
+
+        while len(self._by_id) > self.maxsize:
+            self.remove(next(iter(self._by_id)))
+
+    def remove(self, movie_id):
+        movie = self._by_id.pop(movie_id, None)
+        if movie is None:
+            return
+
+        key = normalize_title(movie.title)
+        if self._by_title.get(key) == movie_id:
+            del self._by_title[key]
+        for phrase in (key, normalize_title(str(movie.title).split(":")[0])):
+            if self._phrases.get(phrase) == movie_id:
+                del self._phrases[phrase]
+        for gram in self._trigrams.pop(movie_id, ()):
+            ids = self._index.get(gram)
+            if ids is not None:
+                ids.discard(movie_id)
+                if not ids:
+                    del self._index[gram]
+
+    def get(self, movie_id):
+        return self._by_id.get(movie_id)
+
+    def movies(self):
+        return list(self._by_id.values())
+
+    def lookup(self, title, fuzzy=True):
+        key = normalize_title(title)
+        if not key:
+            return None
+
+        movie_id = self._by_title.get(key)
+        if movie_id is not None:
+            return self._by_id[movie_id]
+        if not fuzzy:
+            return None
+
+        # Fuzzy match: Jaccard similarity of trigram sets, only scoring movies that share at least one trigram
+        query = trigrams(key)
+        shared = {}
+        for gram in query:
+            for candidate in self._index.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        best_id, best_score, runner_up_score = None, 0.0, 0.0
+        for candidate, count in shared.items():
+            score = count / (len(query) + len(self._trigrams[candidate]) - count)
+            if score > best_score:
+                best_id, best_score, runner_up_score = candidate, score, best_score
+            elif score > runner_up_score:
+                runner_up_score = score
+
+        if best_score < self.min_score or best_score - runner_up_score < self.min_margin:
+            return None
+        return self._by_id[best_id]
+
+    def find_in_text(self, text, min_chars=4):
+        # The movie whose title (or the part before a subtitle colon) appears in `text`, preferring the longest match. Every
+        # run of words in the text up to the longest title is looked up in the phrase index, so the cost doesn't grow
+        # with the size of the catalog.
+        words = normalize_title(text).split()
+        best_id, best_length = None, min_chars - 1
+        for start in range(len(words)):
+            for end in range(start + 1, min(len(words), start + self._max_phrase_words) + 1):
+                phrase = " ".join(words[start:end])
+                if len(phrase) > best_length and (movie_id := self._phrases.get(phrase)) is not None:
+                    best_id, best_length = movie_id, len(phrase)
+        return self._by_id[best_id] if best_id is not None else None
+
+def parse_movie_id(value):
+    # Returns the TMDb ID if `value` looks like one (e.g. 693134 or "693134"), otherwise None. Some titles are numbers too
+    # ("1917"), so callers should check for a movie with that title before using the result as an ID.
+    value = str(value).strip().strip("'\"")
+    return int(value) if value.isdigit() else None
@@ -0,0 +1,37 @@
+import hashlib
+import json
+import os
+import metrics
+import upstream_limits
+from cache import TTLCache
+from session_store import message_to_dict
+
+# Single-flight for non-streaming planner completions. During a burst many sessions open with the same message, so the
+# planner request (system prompt, tools, the one user message, sampling parameters) is byte-for-byte the same. Identical
+# requests that are in flight at the same time share one OpenAI call and all get its result.
+#
+# By default nothing is kept once the call returns. PLANNER_REUSE_TTL (seconds) opts in to reusing a result for a short
+# while afterwards as well. Streaming requests always go straight through.
+
+PLANNER_COALESCING = os.getenv("PLANNER_COALESCING", "1") == "1"
+PLANNER_REUSE_TTL = float(os.getenv("PLANNER_REUSE_TTL") or 0)
+
+completions = TTLCache(maxsize=int(os.getenv("PLANNER_REUSE_MAXSIZE") or 256))
+metrics.register_stats("planner_completions", completions.stats)
+
+def request_key(kwargs):
+    # Messages may be dicts or SDK message objects; both canonicalize to the same JSON
+    canonical = dict(kwargs, messages=[message_to_dict(message) for message in kwargs.get("messages") or []])
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.blake2b(encoded.encode(), digest_size=16).hexdigest()
+
+async def create_planner_completion(client, **kwargs):
+    # Same as upstream_limits.create_chat_completion(); the completion object may be shared, so callers must not modify it
+    if not PLANNER_COALESCING or kwargs.get("stream"):
+        return await upstream_limits.create_chat_completion(client, **kwargs)
+
+    return await completions.get_or_fetch(
+        request_key(kwargs),
+        lambda: upstream_limits.create_chat_completion(client, **kwargs),
+        PLANNER_REUSE_TTL,
+    )
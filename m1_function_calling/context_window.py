@@ -0,0 +1,117 @@
+import os
+
+# Helpers for keeping prompts under a token budget.
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base") # Tokenizer used by gpt-4o / gpt-4o-mini
+except Exception:
+    # tiktoken isn't installed or its encoding couldn't be loaded; fall back to an estimate
+    _encoding = None
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET") or 6000)
+CONTEXT_KEEP_RECENT_TURNS = int(os.getenv("CONTEXT_KEEP_RECENT_TURNS") or 3)
+TOOL_DIGEST_CHARS = int(os.getenv("TOOL_DIGEST_CHARS") or 300)
+
+def estimate_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # Rough estimate (~4 characters per token for English text)
+    return len(text) // 4 + 1
+
+def message_role(message):
+    if isinstance(message, dict):
+        return message.get("role")
+    return getattr(message, "role", None)
+
+def message_content(message):
+    # Assistant messages that requested tool calls carry their payload in the arguments
+    if isinstance(message, dict):
+        content = message.get("content") or ""
+        for tool_call in message.get("tool_calls") or []:
+            content += f"{tool_call['function']['name']}({tool_call['function']['arguments']})"
+        return content
+
+    content = getattr(message, "content", None) or ""
+    for tool_call in getattr(message, "tool_calls", None) or []:
+        content += f"{tool_call.function.name}({tool_call.function.arguments})"
+    return content
+
+def message_tokens(message):
+    # Every message carries a few tokens of overhead for the role and separators
+    return 4 + estimate_tokens(str(message_content(message)))
+
+def history_tokens(messages):
+    return sum(message_tokens(message) for message in messages)
+
+# Keeps the first `keep_head` messages (e.g. the system prompt) and as many of the most recent messages as fit in the budget.
+def trim_history(messages, budget, keep_head=1):
+    head = list(messages[:keep_head])
+    used = history_tokens(head)
+
+    tail = []
+    for message in reversed(messages[keep_head:]):
+        tokens = message_tokens(message)
+        if used + tokens > budget:
+            break
+        tail.append(message)
+        used += tokens
+
+    tail.reverse()
+    return head + tail
+
+def digest(text, max_chars=TOOL_DIGEST_CHARS):
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars].rstrip()}… [{len(text) - max_chars} more characters omitted]"
+
+def is_tool_result(message, index):
+    # Tool results are "tool" messages (app_using_openai.py) or injected "system" context messages (app.py).
+    # The system prompt at index 0 is never a tool result.
+    return index > 0 and isinstance(message, dict) and message_role(message) in ("tool", "system")
+
+def split_turns(messages):
+    # A turn starts at each user message; anything before the first user message is the head (system prompt)
+    starts = [index for index, message in enumerate(messages) if message_role(message) == "user"]
+    if not starts:
+        return list(messages), []
+
+    head = list(messages[:starts[0]])
+    turns = [list(messages[start:end]) for start, end in zip(starts, starts[1:] + [len(messages)])]
+    return head, turns
+
+# Compaction stage run before each chat completion. The system prompt and the most recent turns are kept verbatim, tool
+# results from older turns are shrunk to short digests, and whole turns are dropped (oldest first) until the request fits the
+# budget. Dropping whole turns keeps assistant tool_calls and their tool messages together. The stored history isn't modified.
+def compact_history(messages, budget=None, keep_recent_turns=None):
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    keep_recent_turns = keep_recent_turns or CONTEXT_KEEP_RECENT_TURNS
+
+    if history_tokens(messages) <= budget:
+        return list(messages)
+
+    head, turns = split_turns(messages)
+    offset = len(head)
+    compacted_turns = []
+    for turn_index, turn in enumerate(turns):
+        stale = turn_index < len(turns) - keep_recent_turns
+        compacted_turn = []
+        for message in turn:
+            if stale and is_tool_result(message, offset):
+                message = {**message, "content": digest(message_content(message))}
+            compacted_turn.append(message)
+            offset += 1
+        compacted_turns.append(compacted_turn)
+
+    used = history_tokens(head) + sum(history_tokens(turn) for turn in compacted_turns)
+    while used > budget and len(compacted_turns) > 1:
+        used -= history_tokens(compacted_turns.pop(0))
+
+    if used > budget and compacted_turns:
+        # Only the current turn is left and it's still too large; digest its tool results as a last resort
+        compacted_turns[0] = [
+            {**message, "content": digest(message_content(message))} if is_tool_result(message, len(head) + index) else message
+            for index, message in enumerate(compacted_turns[0])
+        ]
+
+    return head + [message for turn in compacted_turns for message in turn]
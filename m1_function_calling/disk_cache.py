@@ -0,0 +1,135 @@
+import concurrent.futures
+import json
+import os
+import sqlite3
+import time
+
+# Persistent second tier behind the in-process TTLCaches: a SQLite file in WAL mode, so every worker on the host reads and
+# writes the same store and a restarted worker starts warm. Entries keep an absolute expiry (wall-clock time), so a value
+# loaded after a restart only lives for whatever was left of its original TTL.
+#
+# Writes are handed to a single background thread with a connection of its own, which keeps them in order and off the
+# event loop. Reads are small single-row statements on a local file (well under a millisecond) and run inline on the event
+# loop through a separate connection, so they never wait for this worker's writes. In WAL mode they don't wait for other
+# workers' writes either, except while SQLite briefly locks the file (e.g. for a checkpoint); a read gives up after
+# PERSISTENT_CACHE_BUSY_TIMEOUT and is treated as a miss.
+
+PERSISTENT_CACHE_PATH = os.getenv("PERSISTENT_CACHE_PATH", ".cache/tool_cache.sqlite3")
+PERSISTENT_CACHE_WARM_LIMIT = int(os.getenv("PERSISTENT_CACHE_WARM_LIMIT") or 1000)
+PERSISTENT_CACHE_BUSY_TIMEOUT = float(os.getenv("PERSISTENT_CACHE_BUSY_TIMEOUT") or 0.05)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+)
+"""
+
+class DiskCache:
+    def __init__(self, path):
+        self.path = path
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        # Only ever used by the writer thread (after this setup, which may wait on other workers for longer than a read would)
+        self._connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(SCHEMA)
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk_cache")
+        # Used by reads, which run on the event loop (or at startup, before it's running)
+        self._reader = sqlite3.connect(path, timeout=PERSISTENT_CACHE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+
+    @staticmethod
+    def _execute(connection, sql, parameters=()):
+        # A busy (locked) or broken store only costs a cache miss or a lost write; it never fails the request
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            print("Persistent cache error: ", e)
+            return []
+
+    def _read(self, sql, parameters=()):
+        return self._execute(self._reader, sql, parameters)
+
+    def _write(self, sql, parameters=()):
+        self._writer.submit(self._execute, self._connection, sql, parameters)
+
+    def get(self, namespace, key):
+        # Returns (value, remaining ttl) or None
+        rows = self._read("SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+        if not rows:
+            return None
+        value, expires_at = rows[0]
+        remaining = expires_at - time.time()
+        return (value, remaining) if remaining > 0 else None
+
+    def set(self, namespace, key, value, ttl):
+        self._write(
+            "INSERT OR REPLACE INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, value, time.time() + ttl),
+        )
+
+    def load(self, namespace, limit):
+        # Unexpired entries, most recently expiring last so the freshest ones end up at the warm end of an LRU
+        rows = self._read(
+            "SELECT key, value, expires_at FROM entries WHERE namespace = ? AND expires_at > ? ORDER BY expires_at DESC LIMIT ?",
+            (namespace, time.time(), limit),
+        )
+        now = time.time()
+        return [(key, value, expires_at - now) for key, value, expires_at in reversed(rows)]
+
+    def purge_expired(self):
+        self._write("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+
+class PersistentTier:
+    # One namespace of a DiskCache, with keys and values encoded as JSON (or by the given encode/decode functions)
+    def __init__(self, disk, namespace, encode=None, decode=None):
+        self.disk = disk
+        self.namespace = namespace
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+
+    @staticmethod
+    def encode_key(key):
+        return json.dumps(key, separators=(",", ":"))
+
+    @staticmethod
+    def decode_key(key):
+        # JSON turns tuples into lists; keys are tuples all the way down so they're hashable again
+        def to_tuple(value):
+            return tuple(to_tuple(item) for item in value) if isinstance(value, list) else value
+        return to_tuple(json.loads(key))
+
+    def get(self, key):
+        entry = self.disk.get(self.namespace, self.encode_key(key))
+        if entry is None:
+            return None
+        value, remaining = entry
+        return self.decode(json.loads(value)), remaining
+
+    def set(self, key, value, ttl):
+        self.disk.set(self.namespace, self.encode_key(key), json.dumps(self.encode(value), separators=(",", ":")), ttl)
+
+    def load(self, limit=PERSISTENT_CACHE_WARM_LIMIT):
+        return [
+            (self.decode_key(key), self.decode(json.loads(value)), remaining)
+            for key, value, remaining in self.disk.load(self.namespace, limit)
+        ]
+
+_disk = None
+_opened = False
+
+def open_disk_cache():
+    # The process-wide store, or None if PERSISTENT_CACHE_PATH is empty or the file can't be opened
+    global _disk, _opened
+    if not _opened and PERSISTENT_CACHE_PATH:
+        _opened = True
+        try:
+            _disk = DiskCache(PERSISTENT_CACHE_PATH)
+            _disk.purge_expired()
+        except (sqlite3.Error, OSError) as e:
+            print("Persistent cache disabled: ", e)
+    return _disk
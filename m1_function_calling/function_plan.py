@@ -0,0 +1,222 @@
+import json
+from collections import namedtuple
+
+# Parser for app.py's planner responses, e.g. {"functions": ["get_showtimes('The Batman', '95112')"]}.
+# The JSON is recovered even when the model wraps it in other text, and each call expression is tokenized in a single pass,
+# so quoted arguments may contain commas, parentheses and escaped quotes. An unescaped quote inside a string (as in
+# 'Don't Worry Darling') is kept as part of the value unless it's followed by ',' or ')'. Keyword arguments keep their
+# names and are bound to the tool's parameters by name, in whatever order the model wrote them.
+
+class FunctionCall(namedtuple("FunctionCall", ["name", "args", "kwargs"], defaults=((), {}))):
+    __slots__ = ()
+
+    def values(self):
+        return (*self.args, *self.kwargs.values())
+
+class FunctionPlanError(ValueError):
+    pass
+
+class Callback:
+    # Marker for a `callback()` argument, i.e. information that has to be requested from the user first
+    __slots__ = ()
+
+    def __repr__(self):
+        return "callback()"
+
+CALLBACK = Callback()
+
+def skip_whitespace(text, i):
+    while i < len(text) and text[i].isspace():
+        i += 1
+    return i
+
+def scan_string(text, i):
+    # text[i] is the opening quote; returns (value, index after the closing quote)
+    quote = text[i]
+    i += 1
+    chunks = []
+    start = i
+    while i < len(text):
+        char = text[i]
+        if char == "\\" and i + 1 < len(text):
+            chunks.append(text[start:i])
+            chunks.append(text[i + 1])
+            i += 2
+            start = i
+        elif char == quote and ((end := skip_whitespace(text, i + 1)) >= len(text) or text[end] in ",)"):
+            chunks.append(text[start:i])
+            return "".join(chunks), i + 1
+        else:
+            # Including a quote that can't be the closing one, i.e. an unescaped apostrophe in the value
+            i += 1
+    raise FunctionPlanError(f"Unterminated string in {text!r}")
+
+def scan_identifier(text, i):
+    start = i
+    while i < len(text) and (text[i].isalnum() or text[i] == "_"):
+        i += 1
+    return text[start:i], i
+
+def scan_bare(text, i):
+    # Unquoted argument: everything up to the next top-level ',' or ')'
+    start = i
+    depth = 0
+    while i < len(text):
+        char = text[i]
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            if depth == 0:
+                break
+            depth -= 1
+        elif char == "," and depth == 0:
+            break
+        i += 1
+    return text[start:i].strip(), i
+
+def convert_bare(value):
+    if value.replace(" ", "") == "callback()":
+        return CALLBACK
+    # Whole numbers become ints (e.g. TMDb IDs), but not ones with a leading zero like the zip code 02139
+    if value.isdigit() and (value == "0" or not value.startswith("0")):
+        return int(value)
+    return value
+
+def scan_keyword(text, i):
+    # Keyword-style arguments (title='The Batman'); returns (name, index of the value), or (None, i) if there's no keyword
+    name, j = scan_identifier(text, i)
+    j = skip_whitespace(text, j)
+    if name and j < len(text) and text[j] == "=" and text[j + 1:j + 2] != "=":
+        return name, skip_whitespace(text, j + 1)
+    return None, i
+
+def parse_call_at(text, i=0):
+    # Parses `name(arg, ...)` starting at text[i]; returns (FunctionCall, index after the closing parenthesis)
+    i = skip_whitespace(text, i)
+    name, i = scan_identifier(text, i)
+    if not name:
+        raise FunctionPlanError(f"Expected a function name in {text!r}")
+
+    i = skip_whitespace(text, i)
+    if i >= len(text) or text[i] != "(":
+        raise FunctionPlanError(f"Expected '(' after {name} in {text!r}")
+
+    args = []
+    kwargs = {}
+    i = skip_whitespace(text, i + 1)
+    if i < len(text) and text[i] == ")":
+        return FunctionCall(name, ()), i + 1
+
+    while True:
+        keyword, i = scan_keyword(text, skip_whitespace(text, i))
+        if i < len(text) and text[i] in "'\"":
+            value, i = scan_string(text, i)
+            if value.replace(" ", "") == "callback()":
+                value = CALLBACK
+        else:
+            value, i = scan_bare(text, i)
+            value = convert_bare(value)
+        if keyword is None:
+            if kwargs:
+                raise FunctionPlanError(f"Positional argument after keyword arguments in {text!r}")
+            args.append(value)
+        elif keyword in kwargs:
+            raise FunctionPlanError(f"Repeated keyword argument '{keyword}' in {text!r}")
+        else:
+            kwargs[keyword] = value
+
+        i = skip_whitespace(text, i)
+        if i >= len(text):
+            raise FunctionPlanError(f"Missing ')' in {text!r}")
+        if text[i] == ",":
+            i = skip_whitespace(text, i + 1)
+            # Trailing comma, e.g. get_reviews('Dune',)
+            if i < len(text) and text[i] == ")":
+                return FunctionCall(name, tuple(args), kwargs), i + 1
+        elif text[i] == ")":
+            return FunctionCall(name, tuple(args), kwargs), i + 1
+        else:
+            raise FunctionPlanError(f"Expected ',' or ')' in {text!r}")
+
+def parse_call(expression):
+    call, end = parse_call_at(expression)
+    if skip_whitespace(expression, end) != len(expression):
+        raise FunctionPlanError(f"Unexpected text after call in {expression!r}")
+    return call
+
+def find_json_object(text, key):
+    # Returns the first balanced {...} in `text` that parses as JSON and contains `key`
+    start = text.find("{")
+    while start != -1:
+        depth = 0
+        quote = None
+        i = start
+        while i < len(text):
+            char = text[i]
+            if quote:
+                if char == "\\":
+                    i += 1
+                elif char == quote:
+                    quote = None
+            elif char == '"':
+                quote = char
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+                if depth == 0:
+                    try:
+                        data = json.loads(text[start:i + 1])
+                    except ValueError:
+                        break
+                    if isinstance(data, dict) and key in data:
+                        return data
+                    break
+            i += 1
+        start = text.find("{", start + 1)
+    return None
+
+def find_calls(text, names):
+    # Fallback when there's no usable JSON: pick out call expressions for the known function names
+    calls = []
+    for name in names:
+        start = text.find(f"{name}(")
+        while start != -1:
+            before = text[start - 1] if start > 0 else ""
+            if not (before.isalnum() or before == "_"):
+                try:
+                    call, end = parse_call_at(text, start)
+                    calls.append((start, end, call))
+                except FunctionPlanError:
+                    pass
+            start = text.find(f"{name}(", start + 1)
+
+    # Calls used as an argument (e.g. callback() inside get_showtimes(...)) aren't separate calls
+    calls.sort(key=lambda item: item[0])
+    result = []
+    covered_until = -1
+    for start, end, call in calls:
+        if start < covered_until:
+            continue
+        result.append(call)
+        covered_until = end
+    return result
+
+def parse_function_plan(text, names=()):
+    data = find_json_object(text, "functions")
+    if data is None:
+        if not names:
+            raise FunctionPlanError(f"No function plan found in {text!r}")
+        return find_calls(text, names)
+
+    functions = data["functions"] or []
+    if isinstance(functions, str):
+        functions = [functions]
+
+    calls = []
+    for expression in functions:
+        try:
+            calls.append(parse_call(str(expression)))
+        except FunctionPlanError as e:
+            print("Skipping unparseable function call: ", e)
+    return calls
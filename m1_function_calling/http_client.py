@@ -0,0 +1,55 @@
+import os
+import httpx
+
+# Shared, keep-alive connection pools for the upstream APIs used by movie_functions.
+# Each upstream host gets its own httpx.AsyncClient, so the connection limits below are effectively per host.
+# Settings are read when a client is first created.
+
+DEFAULT_TMDB_API_BASE_URL = "https://api.themoviedb.org/3"
+DEFAULT_SERP_API_BASE_URL = "https://serpapi.com"
+
+_clients = {}
+
+def _env_float(name, default):
+    return float(os.getenv(name) or default)
+
+def _env_int(name, default):
+    return int(os.getenv(name) or default)
+
+def _new_client(base_url):
+    timeout = httpx.Timeout(
+        _env_float("HTTP_TIMEOUT", 10.0),
+        connect=_env_float("HTTP_CONNECT_TIMEOUT", 3.0),
+        pool=_env_float("HTTP_POOL_TIMEOUT", 5.0),
+    )
+    limits = httpx.Limits(
+        max_connections=_env_int("HTTP_MAX_CONNECTIONS_PER_HOST", 20),
+        max_keepalive_connections=_env_int("HTTP_MAX_KEEPALIVE_PER_HOST", 10),
+        keepalive_expiry=_env_float("HTTP_KEEPALIVE_EXPIRY", 30.0),
+    )
+    return httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits)
+
+def get_client(base_url):
+    client = _clients.get(base_url)
+    if client is None or client.is_closed:
+        client = _new_client(base_url)
+        _clients[base_url] = client
+    return client
+
+def tmdb_base_url():
+    return os.getenv("TMDB_API_BASE_URL") or DEFAULT_TMDB_API_BASE_URL
+
+def serpapi_base_url():
+    return os.getenv("SERP_API_BASE_URL") or DEFAULT_SERP_API_BASE_URL
+
+def tmdb():
+    return get_client(tmdb_base_url())
+
+def serpapi():
+    return get_client(serpapi_base_url())
+
+async def aclose():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
@@ -0,0 +1,94 @@
+import asyncio
+import contextlib
+import contextvars
+import math
+import os
+import time
+import metrics
+
+# Latency SLO for chat turns. Every turn gets a deadline (TURN_DEADLINE seconds) that's visible to everything it runs,
+# including tool calls, upstream retries and streaming, through a context variable. The turn is cancelled when the
+# deadline passes and the user gets a short fallback instead of a typing indicator that never ends.
+#
+# A worker is under pressure when it has more than DEGRADE_CONCURRENT_TURNS turns in progress, or a turn has less than
+# DEGRADE_REMAINING seconds left. Under pressure, optional work is skipped (speculative tool calls, background prefetches),
+# caches answer from recently expired entries instead of waiting on the upstream, and retries that wouldn't finish
+# before the deadline aren't attempted. Beyond MAX_CONCURRENT_TURNS new turns are turned away straight away.
+#
+# Every event is counted in movies_load_shedding_total{event=...}, and movies_active_turns shows the current load.
+
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE") or 30) # 0 disables the deadline
+DEGRADE_REMAINING = float(os.getenv("DEGRADE_REMAINING") or 10)
+MAX_CONCURRENT_TURNS = int(os.getenv("MAX_CONCURRENT_TURNS") or 100) # Per worker; 0 means unlimited
+DEGRADE_CONCURRENT_TURNS = int(os.getenv("DEGRADE_CONCURRENT_TURNS") or MAX_CONCURRENT_TURNS * 3 // 4)
+
+OVERLOADED_MESSAGE = "I'm getting a lot of questions right now and can't take yours. Please try again in a minute."
+FALLBACK_MESSAGE = "Sorry, I couldn't look that up in time. Please try again in a moment."
+CUT_SHORT_MESSAGE = "\n\n(I ran out of time to finish this answer; ask again if you need the rest.)"
+
+EVENTS_METRIC = "movies_load_shedding_total"
+
+class Overloaded(Exception):
+    pass
+
+_deadline = contextvars.ContextVar("turn_deadline", default=None) # Monotonic time; inf if the turn has no deadline
+_active_turns = 0
+
+metrics.register_collector(lambda: {("movies_active_turns", ()): _active_turns})
+
+def record(event):
+    metrics.increment(EVENTS_METRIC, event=event)
+
+@contextlib.contextmanager
+def turn():
+    # Admits a turn and starts its deadline, or raises Overloaded if the worker is at MAX_CONCURRENT_TURNS
+    global _active_turns
+    if MAX_CONCURRENT_TURNS and _active_turns >= MAX_CONCURRENT_TURNS:
+        record("rejected")
+        raise Overloaded(f"{_active_turns} turns in progress")
+
+    _active_turns += 1
+    token = _deadline.set(time.monotonic() + TURN_DEADLINE if TURN_DEADLINE > 0 else math.inf)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+        _active_turns -= 1
+
+def remaining():
+    # Seconds left in the current turn, or None outside a turn (or if it has no deadline)
+    deadline = _deadline.get()
+    if deadline is None or deadline == math.inf:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+def timeout(default):
+    # A timeout that doesn't run past the turn's deadline
+    left = remaining()
+    return default if left is None else min(default, left)
+
+def degraded():
+    if DEGRADE_CONCURRENT_TURNS and _active_turns > DEGRADE_CONCURRENT_TURNS:
+        return True
+    left = remaining()
+    return left is not None and left < DEGRADE_REMAINING
+
+def shed(work):
+    # True (and counted) if optional `work` should be skipped right now
+    if not degraded():
+        return False
+    record(f"skipped_{work}")
+    return True
+
+async def run_within_deadline(coroutine):
+    # Awaits the coroutine, cancelling it if the turn's deadline passes first; returns False if it was cut short
+    try:
+        await asyncio.wait_for(coroutine, remaining())
+        return True
+    except asyncio.TimeoutError:
+        record("deadline_exceeded")
+        return False
+
+async def finish_cut_short(streamer):
+    # Closes a turn that ran out of time: a fallback if nothing was streamed yet, otherwise a note that it's incomplete
+    await streamer.stream_token(CUT_SHORT_MESSAGE if streamer.tokens else FALLBACK_MESSAGE)
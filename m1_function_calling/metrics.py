@@ -0,0 +1,189 @@
+import asyncio
+import bisect
+import functools
+import os
+import random
+import time
+
+# Low-overhead in-process metrics for the tool-calling pipeline: timing spans feed fixed-bucket histograms, and counters
+# track events. Everything can be rendered in the Prometheus text format, served at /metrics and/or dumped periodically.
+# Spans are sampled (METRICS_SAMPLE_RATE) so instrumentation stays cheap at peak; counters are always recorded.
+
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE") or 1.0)
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL") or 0)
+METRICS_ENDPOINT = os.getenv("METRICS_ENDPOINT", "/metrics")
+
+DURATION_METRIC = "movies_stage_duration_seconds"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+_histograms = {} # (name, labels) -> Histogram
+_counters = {} # (name, labels) -> value
+_collectors = [] # callables returning {(name, labels): value} gauges
+_help = {
+    DURATION_METRIC: "Duration of each stage of the tool-calling pipeline.",
+}
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def observe(name, value, **labels):
+    key = (name, label_key(labels))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram()
+    histogram.observe(value)
+
+def increment(name, amount=1, **labels):
+    key = (name, label_key(labels))
+    _counters[key] = _counters.get(key, 0) + amount
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+def sampled():
+    return METRICS_SAMPLE_RATE >= 1.0 or random.random() < METRICS_SAMPLE_RATE
+
+class Span:
+    __slots__ = ("labels", "started")
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.labels["outcome"] = "cancelled" if issubclass(exc_type, asyncio.CancelledError) else "error"
+        observe(DURATION_METRIC, time.perf_counter() - self.started, **self.labels)
+        return False
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+# Times a stage of the pipeline, e.g. `with metrics.span("tool_call", tool="get_showtimes"):`
+def span(stage, **labels):
+    if not sampled():
+        return NULL_SPAN
+    labels["stage"] = stage
+    return Span(labels)
+
+# Times every call of an async function, e.g. a whole chat turn
+def timed(stage, **labels):
+    def decorator(coroutine_function):
+        @functools.wraps(coroutine_function)
+        async def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return await coroutine_function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Records a duration measured elsewhere (e.g. time-to-first-token), subject to the same sampling as spans
+def observe_duration(stage, seconds, **labels):
+    if seconds is not None and sampled():
+        observe(DURATION_METRIC, seconds, stage=stage, **labels)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{key}="{escape(value)}"' for key, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+# Exposes a stats() dict (TTLCache, ShowtimesStore) as gauges, e.g. movies_cache_hits{cache="tmdb"}
+def register_stats(cache_name, stats):
+    register_collector(lambda: {
+        (f"movies_cache_{key}", (("cache", cache_name),)): value for key, value in stats().items()
+    })
+
+def render_prometheus():
+    lines = []
+
+    for name in sorted({name for name, _ in _histograms}):
+        lines.append(f"# HELP {name} {_help.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), histogram in sorted(_histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+    for name in sorted({name for name, _ in _counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(_counters.items()):
+            if metric == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+    gauges = {}
+    for collector in _collectors:
+        try:
+            gauges.update(collector())
+        except Exception as e:
+            print("Metrics collector failed: ", e)
+    for name in sorted({name for name, _ in gauges}):
+        lines.append(f"# TYPE {name} gauge")
+        for (metric, labels), value in sorted(gauges.items()):
+            if metric == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+def install_endpoint():
+    # Serves the metrics from Chainlit's FastAPI server. The route is inserted first, since Chainlit's catch-all frontend
+    # route would otherwise match the path before it.
+    if not METRICS_ENDPOINT:
+        return
+
+    from chainlit.server import app
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+
+    if any(getattr(route, "path", None) == METRICS_ENDPOINT for route in app.router.routes):
+        return
+
+    async def metrics_endpoint(request):
+        return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    app.router.routes.insert(0, Route(METRICS_ENDPOINT, metrics_endpoint))
+
+async def dump_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(render_prometheus())
+
+_dump_task = None
+
+def start_periodic_dump():
+    global _dump_task
+    if METRICS_DUMP_INTERVAL > 0 and (_dump_task is None or _dump_task.done()):
+        _dump_task = asyncio.create_task(dump_periodically(METRICS_DUMP_INTERVAL))
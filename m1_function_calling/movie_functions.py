@@ -1,42 +1,134 @@
+import asyncio
 import os
-import requests
-from serpapi import GoogleSearch
-import os
+import time
+import httpx
+import http_client
+import metrics
+import upstream_limits
+import load_shedding
+from cache import TTLCache
+from disk_cache import PersistentTier, open_disk_cache
+from records import Movie, Review, Showtime, serialize
+from catalog import MovieCatalog, normalize_title, parse_movie_id
+from now_playing import NowPlayingSnapshot, page_signature
+from review_digest import ReviewDigest, build_digest, format_digest, review_signature
+from showtimes_store import ShowtimesStore, filter_showtimes
+from tool_registry import Parameter, ToolRegistry
 
-def get_now_playing_movies():
-    url = "https://api.themoviedb.org/3/movie/now_playing?language=en-US&page=1"
-    headers = {
-        "Authorization": f"Bearer {os.getenv('TMDB_API_ACCESS_TOKEN')}"
-    }
-    response = requests.get(url, headers=headers)
-    
-    if response.status_code != 200:
-        return f"Error fetching data: {response.status_code} - {response.reason}"
-    
-    data = response.json()
+# Shared on-disk tier behind the TMDb cache and showtimes store, so restarted workers start warm (None if disabled)
+disk_cache = open_disk_cache()
 
-    movies = data.get('results', [])
-    if not movies:
-        return "No movies are currently playing."
+# Expired entries are kept this much longer (seconds) as a fallback when an upstream fails or the worker is under pressure
+STALE_CACHE_TTL = float(os.getenv("STALE_CACHE_TTL") or 3600)
 
-    formatted_movies = "The TMDb API returned these movies:\n\n"
-
-    for movie in movies:
-        title = movie.get('title', 'N/A')
-        movie_id = movie.get('id', 'N/A')
-        release_date = movie.get('release_date', 'N/A')
-        overview = movie.get('overview', 'N/A')
-        formatted_movies += (
-            f"**Title:** {title}\n"
-            f"**Movie ID:** {movie_id}\n"
-            f"**Release Date:** {release_date}\n"
-            f"**Overview:** {overview}\n\n"
-        )
+# Cache for TMDb responses, keyed on endpoint and query parameters. Only title searches go through it; now-playing lives in
+# the synced snapshot and reviews in the precomputed digests below.
+tmdb_cache = TTLCache(
+    maxsize=int(os.getenv("TMDB_CACHE_MAXSIZE") or 512),
+    l2=PersistentTier(disk_cache, "tmdb") if disk_cache else None,
+    stale_ttl=STALE_CACHE_TTL,
+)
 
-    return formatted_movies
+TMDB_CACHE_TTLS = {
+    "search": float(os.getenv("TMDB_SEARCH_TTL") or 24 * 3600),
+}
+
+# How long get_now_playing_movies and get_reviews results count as fresh, which bounds how long the answer cache reuses an
+# answer built on them. They change a few times a day at most.
+NOW_PLAYING_RESULT_TTL = float(os.getenv("NOW_PLAYING_RESULT_TTL") or 3600)
+REVIEWS_RESULT_TTL = float(os.getenv("REVIEWS_RESULT_TTL") or 6 * 3600)
+
+# Every movie seen in a TMDb result is indexed here, so tools can take a title and resolve its TMDb ID locally
+movie_catalog = MovieCatalog()
+CATALOG_REFRESH_INTERVAL = float(os.getenv("CATALOG_REFRESH_INTERVAL") or 1800)
+
+# Every page of now_playing, synced in the background every CATALOG_REFRESH_INTERVAL. A sync only walks all the pages if
+# the first one changed or the last full walk is older than NOW_PLAYING_FULL_SYNC_INTERVAL.
+NOW_PLAYING_MAX_PAGES = int(os.getenv("NOW_PLAYING_MAX_PAGES") or 20)
+NOW_PLAYING_FULL_SYNC_INTERVAL = float(os.getenv("NOW_PLAYING_FULL_SYNC_INTERVAL") or 6 * 3600)
+NOW_PLAYING_PAGE_SIZE = int(os.getenv("NOW_PLAYING_PAGE_SIZE") or 20)
+now_playing_snapshot = NowPlayingSnapshot()
+now_playing_tier = PersistentTier(
+    disk_cache,
+    "now_playing",
+    encode=lambda snapshot: {"signature": snapshot.signature, "movies": [[movie.id, movie.title, movie.release_date, movie.overview] for movie in snapshot.movies()]},
+    decode=lambda data: (data["signature"], [Movie(*row) for row in data["movies"]]),
+) if disk_cache else None
+
+# Full showtimes results keyed by (title, location), optionally prefetched for the top now-playing titles
+SHOWTIMES_TTL = float(os.getenv("SHOWTIMES_TTL") or 1800)
+SHOWTIMES_MAX_ROWS = int(os.getenv("SHOWTIMES_MAX_ROWS") or 8)
+SHOWTIMES_PREFETCH_LOCATIONS = [location.strip() for location in (os.getenv("SHOWTIMES_PREFETCH_LOCATIONS") or "").split(";") if location.strip()]
+SHOWTIMES_PREFETCH_TOP_N = int(os.getenv("SHOWTIMES_PREFETCH_TOP_N") or 5)
+SHOWTIMES_PREFETCH_CONCURRENCY = int(os.getenv("SHOWTIMES_PREFETCH_CONCURRENCY") or 4)
+showtimes_store = ShowtimesStore(
+    ttl=SHOWTIMES_TTL,
+    l2=PersistentTier(
+        disk_cache,
+        "showtimes",
+        encode=lambda showtimes: [[showtime.theater, showtime.day, list(showtime.times)] for showtime in showtimes],
+        decode=lambda rows: [Showtime(*row) for row in rows],
+    ) if disk_cache else None,
+    stale_ttl=STALE_CACHE_TTL,
+)
+
+# Review digests (rating distribution, average and a few excerpts) by TMDb movie ID, built from every page of reviews.
+# They're refreshed in the background for the movies in the catalog, and rebuilt only when the reviews changed.
+REVIEW_MAX_PAGES = int(os.getenv("REVIEW_MAX_PAGES") or 10)
+REVIEW_DIGEST_EXCERPTS = int(os.getenv("REVIEW_DIGEST_EXCERPTS") or 3)
+REVIEW_DIGEST_REFRESH_INTERVAL = float(os.getenv("REVIEW_DIGEST_REFRESH_INTERVAL") or 6 * 3600)
+REVIEW_DIGEST_MAX_MOVIES = int(os.getenv("REVIEW_DIGEST_MAX_MOVIES") or 200)
+REVIEW_DIGEST_CONCURRENCY = int(os.getenv("REVIEW_DIGEST_CONCURRENCY") or 4)
+review_digests = TTLCache(
+    maxsize=int(os.getenv("REVIEW_DIGEST_MAXSIZE") or 2000),
+    l2=PersistentTier(disk_cache, "review_digests", encode=ReviewDigest.to_json, decode=ReviewDigest.from_json) if disk_cache else None,
+    stale_ttl=STALE_CACHE_TTL,
+)
+
+# Warm start from whatever other workers (or this one before a restart) left on disk
+if disk_cache:
+    print(f"Loaded {tmdb_cache.warm()} TMDb responses, {showtimes_store.warm()} showtimes results and {review_digests.warm()} review digests from the persistent cache")
+    if now_playing_tier and (entry := now_playing_tier.get("snapshot")):
+        (signature, movies), _ = entry
+        now_playing_snapshot.apply(movies, signature)
+        movie_catalog.add(movies)
+
+metrics.register_stats("tmdb", tmdb_cache.stats)
+metrics.register_stats("review_digests", review_digests.stats)
+metrics.register_stats("showtimes", showtimes_store.stats)
+
+# Functions the assistant can call; both apps generate their tool definitions from this registry and dispatch through it
+tools = ToolRegistry()
+
+# Fields and truncation used when serializing tool results into the prompt
+MOVIE_FIELDS = ("id", "title", "release_date", "overview")
+TOOL_OVERVIEW_CHARS = int(os.getenv("TOOL_OVERVIEW_CHARS") or 160)
+TOOL_REVIEW_CHARS = int(os.getenv("TOOL_REVIEW_CHARS") or 240) # Per review excerpt
+
+# Rate limits, fair queueing and retries for the upstream APIs (see upstream_limits.py)
+tmdb_limiter = upstream_limits.limiter("tmdb", (httpx.TransportError,))
+serpapi_limiter = upstream_limits.limiter("serpapi", (httpx.TransportError,))
+
+class UpstreamError(Exception):
+    def __init__(self, status_code, reason):
+        super().__init__(f"{status_code} - {reason}")
+        self.status_code = status_code
+        self.reason = reason
+
+def upstream_error_message(e):
+    # Returned as the tool result. Throttling that outlasted the retries shouldn't read like a broken API to the model.
+    if e.status_code in (429, 503):
+        return "This information is temporarily unavailable because the service is busy. Ask the user to try again in a minute."
+    return f"Error fetching data: {e}"
 
-def get_showtimes(title, location):
-    params = {
+def tmdb_headers():
+    return {
+        "accept": "application/json",
+        "Authorization": f"Bearer {os.getenv('TMDB_API_ACCESS_TOKEN')}"
+    }
+
+def showtimes_params(title, location):
+    return {
         "api_key": os.getenv('SERP_API_KEY'),
         "engine": "google",
         "q": f"showtimes for {title}",
@@ -46,61 +138,356 @@ def get_showtimes(title, location):
         "hl": "en"
     }
 
-    search = GoogleSearch(params)
-    results = search.get_dict()
+def buy_ticket(theater, movie, showtime):
+    return f"Ticket purchased for {movie} at {theater} for {showtime}."
+
+# Upstream requests share the keep-alive connection pools in http_client, so a slow response only suspends the calling
+# chat instead of blocking the Chainlit event loop.
 
-    if 'showtimes' not in results:
-        return f"No showtimes found for {title} in {location}."
+async def request_tmdb_json(endpoint, path, params):
+    async def request():
+        with metrics.span("upstream_http", upstream="tmdb", endpoint=endpoint):
+            return await http_client.tmdb().get(path, params=params, headers=tmdb_headers())
+
+    response = await tmdb_limiter.send(request)
+    if response.status_code != 200:
+        raise UpstreamError(response.status_code, response.reason_phrase)
+    return response.json()
+
+async def fetch_tmdb_json(endpoint, path, params):
+    # Only successful responses are cached; errors raise UpstreamError (or fall back to a stale response) and are retried
+    # on the next call. A worker under pressure answers from a stale response straight away if there is one.
+    key = (endpoint, path, tuple(sorted(params.items())))
+    return await tmdb_cache.get_or_fetch(
+        key, lambda: request_tmdb_json(endpoint, path, params), TMDB_CACHE_TTLS[endpoint], serve_stale=load_shedding.degraded()
+    )
+
+def parse_showtimes(results):
+    # Every listed day and theater
+    return [
+        Showtime(
+            theater.get('name', 'Unknown Theater'),
+            day.get('day', 'Unknown Date'),
+            [time for showing in theater.get('showing', []) for time in showing.get('time', [])],
+        )
+        for day in results.get('showtimes') or []
+        for theater in day.get('theaters') or []
+    ]
+
+async def fetch_now_playing_page(page):
+    data = await request_tmdb_json("now_playing", "/movie/now_playing", {"language": "en-US", "page": page})
+    return data, [Movie.from_tmdb(movie) for movie in data.get('results') or []]
+
+async def sync_now_playing():
+    data, first_page = await fetch_now_playing_page(1)
+    signature = page_signature(data.get('total_results'), first_page)
+    full_sync_due = (
+        now_playing_snapshot.full_synced_at is None
+        or time.monotonic() - now_playing_snapshot.full_synced_at > NOW_PLAYING_FULL_SYNC_INTERVAL
+    )
+    if not full_sync_due and signature == now_playing_snapshot.signature:
+        now_playing_snapshot.mark_unchanged()
+        return
+
+    # The remaining pages are fetched in parallel; if any of them fails the previous snapshot is kept
+    total_pages = min(int(data.get('total_pages') or 1), NOW_PLAYING_MAX_PAGES)
+    pages = await asyncio.gather(*(fetch_now_playing_page(page) for page in range(2, total_pages + 1)))
+    movies = first_page + [movie for _, page_movies in pages for movie in page_movies]
+
+    added, removed, changed = now_playing_snapshot.apply(movies, signature)
+    movie_catalog.add(movies)
+    if now_playing_tier:
+        now_playing_tier.set("snapshot", now_playing_snapshot, NOW_PLAYING_FULL_SYNC_INTERVAL)
+    print(f"Synced {len(now_playing_snapshot)} now playing movies from {total_pages} pages: {added} added, {removed} removed, {changed} changed")
+
+_now_playing_sync = None
+
+async def sync_now_playing_once():
+    # Concurrent callers share one sync
+    global _now_playing_sync
+    if _now_playing_sync is None or _now_playing_sync.done():
+        _now_playing_sync = asyncio.ensure_future(sync_now_playing())
+    await asyncio.shield(_now_playing_sync)
 
-    showtimes = results['showtimes'][0]
-    formatted_showtimes = f"Showtimes for {title} in {location}:\n\n"
+async def fetch_now_playing_movies():
+    # Served from the snapshot; only the very first call (before any sync has finished) goes to TMDb
+    if now_playing_snapshot.synced_at is None:
+        await sync_now_playing_once()
+    return now_playing_snapshot.movies()
 
-    if showtimes['theaters']:
-        theater = showtimes['theaters'][0]
-        theater_name = theater.get('name', 'Unknown Theater')
-        formatted_showtimes += f"**{theater_name}**\n"
+async def search_movies(title):
+    data = await fetch_tmdb_json("search", "/search/movie", {"query": title, "language": "en-US", "page": 1})
+    movies = [Movie.from_tmdb(movie) for movie in data.get('results', [])]
+    movie_catalog.add(movies)
+    return movies
 
-        date = showtimes.get('day', 'Unknown Date')
-        formatted_showtimes += f"  {date}:\n"
+# Accepts a TMDb ID or a title and returns the Movie, or None if nothing matches. Titles are resolved from the local catalog,
+# falling back to a TMDb search (and its best result) for unseen movies or ones the catalog can't tell apart. A number is
+# only taken as an ID if no movie has it as its title, like "1917".
+async def resolve_movie(movie):
+    title = str(movie).strip().strip("'\"")
+    movie_id = parse_movie_id(title)
+    # A number only ever matches a title exactly; fuzzy matching would turn an ID into whichever title looks closest
+    if (match := movie_catalog.lookup(title, fuzzy=movie_id is None)) is not None:
+        return match
+    if movie_id is not None and movie_id in movie_catalog:
+        return movie_catalog.get(movie_id)
 
-        for showing in theater.get('showing', []):
-            for time in showing.get('time', []):
-                formatted_showtimes += f"    - {time}\n"
+    results = await search_movies(title)
+    key = normalize_title(title)
+    exact = next((result for result in results if normalize_title(result.title) == key), None)
+    if movie_id is not None:
+        return exact or Movie(movie_id, None, None, None)
+    return exact or movie_catalog.lookup(title) or (results[0] if results else None)
 
-    formatted_showtimes += "\n"
+async def sync_now_playing_periodically():
+    # Also keeps the movie catalog up to date
+    while True:
+        try:
+            await sync_now_playing_once()
+        except Exception as e:
+            print("Now playing sync failed: ", e)
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL)
 
+async def prefetch_showtimes_periodically():
+    # Keeps showtimes for the top now-playing titles at popular locations warm, so common questions skip the search
+    semaphore = asyncio.Semaphore(SHOWTIMES_PREFETCH_CONCURRENCY)
+
+    async def prefetch(title, location):
+        async with semaphore:
+            try:
+                await fetch_showtimes(title, location)
+            except Exception as e:
+                print(f"Showtimes prefetch failed for {title} in {location}: ", e)
+
+    while True:
+        # Skipped while the worker is under pressure; the showtimes store falls back to stale entries meanwhile
+        if not load_shedding.shed("showtimes_prefetch"):
+            try:
+                movies = await fetch_now_playing_movies()
+                await asyncio.gather(*(
+                    prefetch(movie.title, location)
+                    for movie in movies[:SHOWTIMES_PREFETCH_TOP_N]
+                    for location in SHOWTIMES_PREFETCH_LOCATIONS
+                ))
+            except Exception as e:
+                print("Showtimes prefetch failed: ", e)
+        # Refresh a little before the entries expire
+        await asyncio.sleep(SHOWTIMES_TTL * 0.8)
+
+_background_tasks = {}
+
+def start_background_task(name, coroutine_function):
+    task = _background_tasks.get(name)
+    if task is None or task.done():
+        _background_tasks[name] = asyncio.create_task(coroutine_function())
+
+def start_background_tasks():
+    # Safe to call repeatedly; only one of each background loop runs per process
+    start_background_task("now_playing_sync", sync_now_playing_periodically)
+    start_background_task("review_digests", refresh_review_digests_periodically)
+    if SHOWTIMES_PREFETCH_LOCATIONS:
+        start_background_task("showtimes_prefetch", prefetch_showtimes_periodically)
+
+async def fetch_showtimes(title, location):
+    # SerpAPI's Google search endpoint, which answers showtimes queries with a "showtimes" block
+    async def request():
+        with metrics.span("upstream_http", upstream="serpapi", endpoint="search"):
+            return await http_client.serpapi().get(
+                "/search.json",
+                params=showtimes_params(title, location),
+            )
+
+    async def fetch():
+        response = await serpapi_limiter.send(request)
+        if response.status_code != 200:
+            raise UpstreamError(response.status_code, response.reason_phrase)
+
+        return parse_showtimes(response.json())
+
+    return await showtimes_store.get_or_fetch(title, location, fetch, serve_stale=load_shedding.degraded())
+
+async def fetch_review_page(movie_id, page):
+    data = await request_tmdb_json("reviews", f"/movie/{movie_id}/reviews", {"language": "en-US", "page": page})
+    return data, [Review.from_tmdb(review) for review in data.get('results') or []]
+
+async def build_review_digest(movie_id, first_page=None):
+    # Walks every page of reviews (the rest in parallel once page 1 says how many there are)
+    data, reviews = first_page or await fetch_review_page(movie_id, 1)
+    total_pages = min(int(data.get('total_pages') or 1), REVIEW_MAX_PAGES)
+    pages = await asyncio.gather(*(fetch_review_page(movie_id, page) for page in range(2, total_pages + 1)))
+    all_reviews = reviews + [review for _, page_reviews in pages for review in page_reviews]
+    signature = review_signature(data.get('total_results'), reviews)
+    return build_digest(movie_id, all_reviews, signature, REVIEW_DIGEST_EXCERPTS, TOOL_REVIEW_CHARS)
+
+def review_digest_is_fresh(movie_id):
+    # Digests are stored for twice the refresh interval, so one with more than an interval left was checked within the last
+    # one, by this worker or (through the persistent tier) by another one or before a restart
+    remaining = review_digests.remaining(movie_id)
+    if (remaining is None or remaining <= REVIEW_DIGEST_REFRESH_INTERVAL) and review_digests.l2 is not None:
+        if (entry := review_digests.l2.get(movie_id)) is not None and entry[1] > (remaining or 0):
+            digest, remaining = entry
+            review_digests.set(movie_id, digest, remaining)
+    return remaining is not None and remaining > REVIEW_DIGEST_REFRESH_INTERVAL
+
+async def refresh_review_digest(movie_id):
+    # Page 1 is enough to tell whether anything changed; the digest is only rebuilt if it did
+    first_page = await fetch_review_page(movie_id, 1)
+    digest = review_digests.peek(movie_id)
+    if digest is None or digest.signature != review_signature(first_page[0].get('total_results'), first_page[1]):
+        digest = await build_review_digest(movie_id, first_page)
+    review_digests.set(movie_id, digest, REVIEW_DIGEST_REFRESH_INTERVAL * 2)
+    if review_digests.l2 is not None:
+        review_digests.l2.set(movie_id, digest, REVIEW_DIGEST_REFRESH_INTERVAL * 2)
+
+async def fetch_review_digest(movie_id):
+    # Normally precomputed; movies the background refresh hasn't reached yet are digested on demand
+    return await review_digests.get_or_fetch(
+        movie_id, lambda: build_review_digest(movie_id), REVIEW_DIGEST_REFRESH_INTERVAL * 2, serve_stale=load_shedding.degraded()
+    )
+
+async def refresh_review_digests_periodically():
+    semaphore = asyncio.Semaphore(REVIEW_DIGEST_CONCURRENCY)
+
+    async def refresh(movie_id):
+        async with semaphore:
+            try:
+                await refresh_review_digest(movie_id)
+            except Exception as e:
+                print(f"Review digest refresh failed for {movie_id}: ", e)
+
+    # The first pass needs the movies from the first now-playing sync (shared with the sync loop if it's already running)
+    try:
+        await sync_now_playing_once()
+    except Exception as e:
+        print("Now playing sync failed: ", e)
+
+    # Passes run as often as the now-playing sync, so new movies are picked up soon after they appear. Digests checked
+    # within the last REVIEW_DIGEST_REFRESH_INTERVAL are skipped, so a pass (or a restart) usually only fetches a few.
+    while True:
+        if not load_shedding.shed("review_digest_refresh"):
+            # Now-playing movies first, then anything else the catalog has seen
+            movie_ids = dict.fromkeys(movie.id for movie in now_playing_snapshot.movies() + movie_catalog.movies())
+            stale_ids = [movie_id for movie_id in list(movie_ids)[:REVIEW_DIGEST_MAX_MOVIES] if not review_digest_is_fresh(movie_id)]
+            await asyncio.gather(*(refresh(movie_id) for movie_id in stale_ids))
+            if stale_ids:
+                print(f"Refreshed review digests for {len(stale_ids)} movies")
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL)
+
+# Tool-facing variants: the records above serialized into a compact, field-selected form for the prompt
+
+@tools.register(
+    "get_now_playing_movies",
+    "Get a list of movies that are playing now. Call this whenever you need to know the current movies playing in the theatres, for example when a customer asks 'What movies are currently playing?' Results are paginated; the optional filters narrow them down.",
+    parameters=[
+        Parameter("keyword", "Optional. Only movies whose title or overview mentions this, for example 'horror' or 'robot'.", required=False),
+        Parameter("released_after", "Optional. Only movies released on or after this date (YYYY-MM-DD).", required=False),
+        Parameter("released_before", "Optional. Only movies released on or before this date (YYYY-MM-DD).", required=False),
+        Parameter("page", "Optional. The page of results to return, starting at 1.", type="integer", required=False),
+    ],
+    label="now_playing_movies",
+    ttl=NOW_PLAYING_RESULT_TTL,
+)
+async def get_now_playing_movies(keyword=None, released_after=None, released_before=None, page=1):
+    page = max(1, page)
+    try:
+        await fetch_now_playing_movies()
+    except UpstreamError as e:
+        return upstream_error_message(e)
+
+    movies, total = now_playing_snapshot.query(keyword, released_after, released_before, page, NOW_PLAYING_PAGE_SIZE)
+    if not total:
+        if keyword or released_after or released_before:
+            return "No movies currently playing match the requested keyword or release dates."
+        return "No movies are currently playing."
+
+    pages = -(-total // NOW_PLAYING_PAGE_SIZE)
+    if not movies:
+        return f"There are only {pages} pages of results."
+
+    formatted_movies = serialize(movies, fields=MOVIE_FIELDS, max_chars={"overview": TOOL_OVERVIEW_CHARS})
+    if pages > 1:
+        formatted_movies += f"\n(Page {page} of {pages}, {total} movies in total."
+        formatted_movies += f" Pass page={page + 1} for more.)" if page < pages else ")"
+    return formatted_movies
+
+@tools.register(
+    "get_showtimes",
+    "Get the showtimes for a particular movie playing at a certain location. Call this whenever you need to know the showtimes for a specific movie at a specific location, for example when a customer asks 'What are the showtimes for The Batman in New York?'",
+    parameters=[
+        Parameter("title", "The title of the movie for which you want to get the showtimes."),
+        Parameter("location", "The zip code for which you want to get the showtimes."),
+        Parameter("theater", "Optional. Only return showtimes at theaters whose name contains this, for example when a customer asks about a specific theater.", required=False),
+        Parameter("after", "Optional. Only return showtimes later than this time (e.g. '7:30pm'), for example when a customer asks for a later show.", required=False),
+        Parameter("day", "Optional. Only return showtimes on days matching this (e.g. 'Tomorrow' or 'Sat').", required=False),
+    ],
+    label="showtimes",
+    ttl=SHOWTIMES_TTL,
+)
+async def get_showtimes(title, location, theater=None, after=None, day=None):
+    try:
+        showtimes = await fetch_showtimes(title, location)
+    except UpstreamError as e:
+        return upstream_error_message(e)
+
+    if not showtimes:
+        return f"No showtimes found for {title} in {location}."
+
+    # Follow-up questions (a later show, another theater, another day) are answered from the stored result
+    showtimes = filter_showtimes(showtimes, theater=theater, after=after, day=day)
+    if not showtimes:
+        return f"No showtimes found for {title} in {location} matching the requested theater, day or time."
+
+    formatted_showtimes = f"Showtimes for {title} in {location}:\n" + serialize(showtimes[:SHOWTIMES_MAX_ROWS])
+    if len(showtimes) > SHOWTIMES_MAX_ROWS:
+        formatted_showtimes += f"\n({len(showtimes) - SHOWTIMES_MAX_ROWS} more theater/day rows available; filter by theater, day or time to see them.)"
     return formatted_showtimes
 
-def buy_ticket(theater, movie, showtime):
-    return f"Ticket purchased for {movie} at {theater} for {showtime}."
+@tools.register(
+    "get_reviews",
+    "Get the reviews for a particular movie. Call this whenever you need to know the reviews for a specific movie, for example when a customer asks 'What are critics saying about The Batman?'",
+    parameters=[
+        Parameter("movie", "The TMDB movie ID of the movie for which you want to get the reviews. If you don't know the ID, pass the movie title instead."),
+    ],
+    label="reviews",
+    ttl=REVIEWS_RESULT_TTL,
+)
+async def get_reviews(movie):
+    try:
+        match = await resolve_movie(movie)
+        if match is None:
+            return f"No movie found matching {movie}."
+        digest = await fetch_review_digest(match.id)
+    except UpstreamError as e:
+        return upstream_error_message(e)
 
-def get_reviews(movie_id):
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}/reviews?language=en-US&page=1"
-    headers = {
-        "accept": "application/json",
-        "Authorization": f"Bearer {os.getenv('TMDB_API_ACCESS_TOKEN')}"
-    }
-    response = requests.get(url, headers=headers)
-    reviews_data = response.json()
-
-    if 'results' not in reviews_data or not reviews_data['results']:
-        return "No reviews found."
-
-    formatted_reviews = ""
-    for review in reviews_data['results']:
-        author = review.get('author', 'N/A')
-        rating = review.get('author_details', {}).get('rating', 'N/A')
-        content = review.get('content', 'N/A')
-        created_at = review.get('created_at', 'N/A')
-        url = review.get('url', 'N/A')
-
-        formatted_reviews += (
-            f"**Author:** {author}\n"
-            f"**Rating:** {rating}\n"
-            f"**Content:** {content}\n"
-            f"**Created At:** {created_at}\n"
-            f"**URL:** {url}\n"
-            "----------------------------------------\n"
-        )
+    return format_digest(digest, match.title)
+
+TICKET_PARAMETERS = [
+    Parameter("theater", "The name of the theater where the movie is playing."),
+    Parameter("movie", "The title of the movie for which you want to buy the ticket."),
+    Parameter("showtime", "The time at which the movie is playing."),
+]
+
+@tools.register(
+    "buy_ticket",
+    "Buy a ticket for a particular movie at a specific location and time. Call this whenever you need to buy a ticket for a customer, for example when a customer asks an you buy me a ticket for The Batman at AMC Metreon at 7pm?'",
+    parameters=TICKET_PARAMETERS,
+    label="need_confirmation_to_buy_ticket",
+    side_effects=True,
+)
+def request_ticket_purchase(theater, movie, showtime):
+    # Tickets are only bought once the user confirms, through confirm_ticket_purchase
+    return f"Ask the user if they really want to buy the ticket for {movie} at {theater} on {showtime}. If they confirm, call confirm_ticket_purchase()."
 
-    return formatted_reviews
\ No newline at end of file
+@tools.register(
+    "confirm_ticket_purchase",
+    "Confirm the purchase of a ticket for a particular movie at a specific location and time. Call this whenever you need to confirm the purchase of a ticket for a customer, for example when a customer asks 'Yes, I want to buy a ticket for The Batman at AMC Metreon at 7pm.'",
+    parameters=TICKET_PARAMETERS,
+    label="ticket_purchase_confirmation",
+    side_effects=True,
+)
+def confirm_ticket_purchase(theater, movie, showtime):
+    context = buy_ticket(theater, movie, showtime)
+    context += " Just pretend you bought a ticket." # Without this, the assistant responds that it can't buy tickets.
+    return context
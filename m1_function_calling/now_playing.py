@@ -0,0 +1,67 @@
+import hashlib
+import time
+from catalog import normalize_title
+
+# Local snapshot of every page of TMDb's now_playing list, kept up to date by a background sync in movie_functions. The
+# get_now_playing_movies tool answers from the snapshot (optionally filtered and paginated) without any network calls.
+
+def page_signature(total_results, movies):
+    # Cheap change detector for a sync: if the first page and the total are unchanged, the rest almost certainly is too
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(total_results).encode())
+    for movie in movies:
+        digest.update(f"{movie.id}:{movie.release_date}\0".encode())
+    return digest.hexdigest()
+
+class NowPlayingSnapshot:
+    def __init__(self):
+        self._movies = {} # movie id -> Movie, in TMDb's order
+        self.signature = None
+        self.synced_at = None # monotonic time of the last sync that checked for changes
+        self.full_synced_at = None # monotonic time of the last sync that walked every page
+
+    def __len__(self):
+        return len(self._movies)
+
+    def movies(self):
+        return list(self._movies.values())
+
+    def apply(self, movies, signature):
+        # Replaces the snapshot with a complete listing, returning (added, removed, changed) counts. Only IDs and release
+        # dates are compared, since those are what the listing is about; other fields are updated either way.
+        current = {}
+        for movie in movies:
+            if movie.id is not None:
+                current.setdefault(movie.id, movie)
+
+        added = current.keys() - self._movies.keys()
+        removed = self._movies.keys() - current.keys()
+        changed = [
+            movie_id for movie_id in current.keys() & self._movies.keys()
+            if current[movie_id].release_date != self._movies[movie_id].release_date
+        ]
+
+        self._movies = current
+        self.signature = signature
+        self.synced_at = self.full_synced_at = time.monotonic()
+        return len(added), len(removed), len(changed)
+
+    def mark_unchanged(self):
+        self.synced_at = time.monotonic()
+
+    def query(self, keyword=None, released_after=None, released_before=None, page=1, page_size=20):
+        # Returns (movies on the requested page, number of matching movies). Dates compare as YYYY-MM-DD strings.
+        keyword = normalize_title(keyword) if keyword else None
+        matches = []
+        for movie in self._movies.values():
+            release_date = movie.release_date or ""
+            if released_after and release_date < released_after:
+                continue
+            if released_before and release_date > released_before:
+                continue
+            if keyword and keyword not in normalize_title(f"{movie.title} {movie.overview}"):
+                continue
+            matches.append(movie)
+
+        start = (max(1, page) - 1) * page_size
+        return matches[start:start + page_size], len(matches)
@@ -0,0 +1,98 @@
+import json
+import os
+
+# Typed records for the data returned by movie_functions, and a compact serializer for putting them into prompts.
+
+TOOL_RESULT_FORMAT = os.getenv("TOOL_RESULT_FORMAT") or "table"
+
+class Movie:
+    __slots__ = ("id", "title", "release_date", "overview")
+
+    def __init__(self, id, title, release_date, overview):
+        self.id = id
+        self.title = title
+        self.release_date = release_date
+        self.overview = overview
+
+    @classmethod
+    def from_tmdb(cls, movie):
+        return cls(
+            movie.get('id'),
+            movie.get('title', 'N/A'),
+            movie.get('release_date', 'N/A'),
+            movie.get('overview', 'N/A'),
+        )
+
+    def __repr__(self):
+        return f"Movie(id={self.id!r}, title={self.title!r})"
+
+class Review:
+    __slots__ = ("author", "rating", "content", "created_at", "url")
+
+    def __init__(self, author, rating, content, created_at, url):
+        self.author = author
+        self.rating = rating
+        self.content = content
+        self.created_at = created_at
+        self.url = url
+
+    @classmethod
+    def from_tmdb(cls, review):
+        return cls(
+            review.get('author', 'N/A'),
+            (review.get('author_details') or {}).get('rating'),
+            review.get('content', 'N/A'),
+            review.get('created_at', 'N/A'),
+            review.get('url', 'N/A'),
+        )
+
+    def __repr__(self):
+        return f"Review(author={self.author!r}, rating={self.rating!r})"
+
+class Showtime:
+    __slots__ = ("theater", "day", "times")
+
+    def __init__(self, theater, day, times):
+        self.theater = theater
+        self.day = day
+        self.times = tuple(times)
+
+    def __repr__(self):
+        return f"Showtime(theater={self.theater!r}, day={self.day!r}, times={self.times!r})"
+
+def truncate(text, max_chars):
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip() + "…"
+
+def field_value(record, field, max_chars):
+    value = getattr(record, field)
+    if value is None:
+        return ""
+    if isinstance(value, tuple):
+        value = ", ".join(str(item) for item in value)
+    if isinstance(value, str):
+        return truncate(" ".join(value.split()), max_chars.get(field))
+    return value
+
+def to_rows(records, fields, max_chars):
+    return [[field_value(record, field, max_chars) for field in fields] for record in records]
+
+# Serializes records to a compact, field-selected form: "table" (pipe-separated with a header row) or "json" (a list of
+# objects without whitespace). Text fields are whitespace-collapsed and can be truncated per field with `max_chars`.
+def serialize(records, fields=None, max_chars=None, format=None):
+    if not records:
+        return ""
+
+    fields = fields or type(records[0]).__slots__
+    max_chars = max_chars or {}
+    format = format or TOOL_RESULT_FORMAT
+    rows = to_rows(records, fields, max_chars)
+
+    if format == "json":
+        return json.dumps([dict(zip(fields, row)) for row in rows], separators=(",", ":"), ensure_ascii=False)
+
+    lines = ["|".join(fields)]
+    for row in rows:
+        lines.append("|".join(str(value).replace("|", "/") for value in row))
+    return "\n".join(lines)
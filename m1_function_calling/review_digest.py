@@ -0,0 +1,125 @@
+import hashlib
+import re
+import time
+from collections import Counter
+
+# Compact per-movie review digests: how many reviews there are, the author rating distribution and average, and a few
+# representative excerpts. Excerpts are picked extractively: each review's most central sentence (the one sharing the
+# most vocabulary with the other reviews) is a candidate, and candidates are taken round-robin from the positive,
+# negative and mixed reviews so the excerpts reflect the overall split.
+
+RATING_BUCKETS = ((9, 10), (7, 8), (5, 6), (3, 4), (1, 2))
+
+STOPWORDS = frozenset("""
+    a about after all also an and any are as at be because been but by can could did do does for from had has have he her
+    his how i if in into is it its just like more most much my no not of on one or our out so some than that the their them
+    then there these they this to too up was we were what when which while who will with would you your film movie
+""".split())
+
+def review_signature(total_results, reviews):
+    # Changes when reviews are added, removed or edited on the first page, or the total changes
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(total_results).encode())
+    for review in reviews:
+        digest.update(f"{review.url}:{review.created_at}\0".encode())
+    return digest.hexdigest()
+
+def split_sentences(text):
+    text = " ".join(str(text).split())
+    return [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+", text) if sentence.strip()]
+
+def content_words(text):
+    return {word for word in re.findall(r"[a-z']+", text.lower()) if len(word) > 2 and word not in STOPWORDS}
+
+def bucket_index(rating):
+    for index, (low, _) in enumerate(RATING_BUCKETS):
+        if rating >= low:
+            return index
+    return len(RATING_BUCKETS) - 1
+
+def rating_group(rating):
+    if rating is None:
+        return "unrated"
+    if rating >= 7:
+        return "positive"
+    if rating <= 4:
+        return "negative"
+    return "mixed"
+
+def truncate(text, max_chars):
+    return text if len(text) <= max_chars else text[:max_chars - 3].rstrip() + "..."
+
+class ReviewDigest:
+    __slots__ = ("movie_id", "review_count", "average_rating", "distribution", "excerpts", "signature", "built_at")
+
+    def __init__(self, movie_id, review_count, average_rating, distribution, excerpts, signature, built_at=None):
+        self.movie_id = movie_id
+        self.review_count = review_count
+        self.average_rating = average_rating
+        self.distribution = distribution # [count per RATING_BUCKETS entry]
+        self.excerpts = excerpts # [(author, rating, sentence)]
+        self.signature = signature
+        self.built_at = built_at or time.time()
+
+    def to_json(self):
+        return [self.movie_id, self.review_count, self.average_rating, self.distribution, self.excerpts, self.signature, self.built_at]
+
+    @classmethod
+    def from_json(cls, data):
+        movie_id, review_count, average_rating, distribution, excerpts, signature, built_at = data
+        return cls(movie_id, review_count, average_rating, distribution, [tuple(excerpt) for excerpt in excerpts], signature, built_at)
+
+def build_digest(movie_id, reviews, signature, max_excerpts=3, excerpt_chars=240):
+    ratings = [review.rating for review in reviews if review.rating is not None]
+    distribution = [0] * len(RATING_BUCKETS)
+    for rating in ratings:
+        distribution[bucket_index(rating)] += 1
+    average_rating = round(sum(ratings) / len(ratings), 1) if ratings else None
+
+    # Document frequency of each word across reviews; a sentence is central if its words appear in many reviews
+    review_words = [content_words(review.content) for review in reviews]
+    frequency = Counter(word for words in review_words for word in words)
+
+    candidates = {} # rating group -> [(score, author, rating, sentence)]
+    for review in reviews:
+        best = None
+        for sentence in split_sentences(review.content):
+            if not 40 <= len(sentence) <= 2 * excerpt_chars:
+                continue
+            words = content_words(sentence)
+            if not words:
+                continue
+            score = sum(frequency[word] - 1 for word in words) / len(words) ** 0.5
+            if best is None or score > best[0]:
+                best = (score, review.author, review.rating, truncate(sentence, excerpt_chars))
+        if best:
+            candidates.setdefault(rating_group(review.rating), []).append(best)
+
+    # Round-robin over the groups, largest first, taking each group's most central sentences
+    groups = sorted(candidates.values(), key=len, reverse=True)
+    for group in groups:
+        group.sort(key=lambda candidate: candidate[0], reverse=True)
+    excerpts = []
+    while len(excerpts) < max_excerpts and any(groups):
+        for group in groups:
+            if group and len(excerpts) < max_excerpts:
+                _, author, rating, sentence = group.pop(0)
+                excerpts.append((author, rating, sentence))
+
+    return ReviewDigest(movie_id, len(reviews), average_rating, distribution, excerpts, signature)
+
+def format_digest(digest, title=None):
+    # The title the request resolved to goes first, so a wrong match is visible in the answer
+    movie = f"{title} (TMDb ID {digest.movie_id})" if title else f"TMDb ID {digest.movie_id}"
+    if not digest.review_count:
+        return f"No reviews found for {movie}."
+
+    rated = sum(digest.distribution)
+    lines = [f"Reviews for {movie}: {digest.review_count} reviews" + (f", average author rating {digest.average_rating}/10 from {rated} ratings" if rated else "")]
+    if rated:
+        lines.append("Ratings: " + ", ".join(
+            f"{low}-{high}: {count}" for (low, high), count in zip(RATING_BUCKETS, digest.distribution) if count
+        ))
+    for author, rating, sentence in digest.excerpts:
+        lines.append(f"- {author}" + (f" ({rating:g}/10)" if rating is not None else "") + f": \"{sentence}\"")
+    return "\n".join(lines)
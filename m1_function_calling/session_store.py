@@ -0,0 +1,254 @@
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import metrics
+
+# Conversation state kept outside the worker process, so a session can be served by any worker behind a load balancer and
+# survives a restart. Each history is a list of compact JSON messages (system prompts and empty fields aren't stored) and a
+# turn only appends the messages it added.
+#
+# Backends implement the handful of Redis list commands the store needs (rpush, lrange, delete, expire), so a redis.asyncio
+# client can be used as-is. SESSION_STORE_URL picks one:
+#   (empty)                      in-process memory, the default (sessions don't outlive the worker)
+#   sqlite:///path/to/file       a SQLite file in WAL mode, shared by every worker on the host
+#   redis://host:6379/0          Redis, shared across hosts (needs the redis package)
+
+SESSION_STORE_URL = os.getenv("SESSION_STORE_URL") or ""
+SESSION_TTL = float(os.getenv("SESSION_TTL") or 24 * 3600)
+
+ERRORS_METRIC = "movies_session_store_errors_total"
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    # redis isn't installed; only the memory and SQLite backends are available
+    redis = None
+
+def redis_range(values, start, stop):
+    # LRANGE semantics: both ends inclusive, negative indices count from the end
+    return values[start:None if stop == -1 else stop + 1]
+
+class MemoryBackend:
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self._lists = {}
+        self._expires_at = {}
+        self._swept_at = time.monotonic()
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._swept_at < self.SWEEP_INTERVAL:
+            return
+        self._swept_at = now
+        for key in [key for key, expires_at in self._expires_at.items() if expires_at <= now]:
+            self._lists.pop(key, None)
+            del self._expires_at[key]
+
+    def _drop_if_expired(self, key):
+        expires_at = self._expires_at.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._lists.pop(key, None)
+            del self._expires_at[key]
+
+    async def rpush(self, key, *values):
+        self._sweep()
+        self._drop_if_expired(key)
+        self._lists.setdefault(key, []).extend(values)
+        return len(self._lists[key])
+
+    async def lrange(self, key, start, stop):
+        self._drop_if_expired(key)
+        return redis_range(self._lists.get(key, []), start, stop)
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            deleted += self._lists.pop(key, None) is not None
+            self._expires_at.pop(key, None)
+        return deleted
+
+    async def expire(self, key, seconds):
+        if key not in self._lists:
+            return False
+        self._expires_at[key] = time.monotonic() + seconds
+        return True
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_entries (
+    key TEXT NOT NULL,
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS session_entries_key ON session_entries (key, seq);
+CREATE TABLE IF NOT EXISTS session_expiry (
+    key TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+"""
+
+class SQLiteBackend:
+    # One WAL-mode file per host, like disk_cache.DiskCache. Statements run in a worker thread (asyncio.to_thread) so waiting
+    # on another worker's write lock never blocks the event loop, and every multi-statement write is a transaction that's
+    # rolled back if it fails. Appends are plain INSERTs, so a turn never rewrites the earlier messages.
+    def __init__(self, path):
+        self.path = path
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(SCHEMA)
+        self._purge_expired()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Holds the lock for the whole transaction; a failed one is rolled back so the connection stays usable
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def _delete_expired(self, connection, condition, parameters):
+        now = time.time()
+        connection.execute(
+            f"DELETE FROM session_entries WHERE key IN (SELECT key FROM session_expiry WHERE {condition} AND expires_at <= ?)",
+            (*parameters, now),
+        )
+        connection.execute(f"DELETE FROM session_expiry WHERE {condition} AND expires_at <= ?", (*parameters, now))
+
+    def _purge_expired(self):
+        with self._transaction() as connection:
+            self._delete_expired(connection, "1", ())
+
+    def _rpush(self, key, values):
+        with self._transaction() as connection:
+            # An expired list starts over instead of reappearing once the new expiry is set
+            self._delete_expired(connection, "key = ?", (key,))
+            connection.executemany("INSERT INTO session_entries (key, value) VALUES (?, ?)", [(key, value) for value in values])
+            return connection.execute("SELECT COUNT(*) FROM session_entries WHERE key = ?", (key,)).fetchone()[0]
+
+    def _lrange(self, key):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT value FROM session_entries WHERE key = ? AND NOT EXISTS "
+                "(SELECT 1 FROM session_expiry WHERE key = ? AND expires_at <= ?) ORDER BY seq",
+                (key, key, time.time()),
+            ).fetchall()
+
+    def _delete(self, keys):
+        deleted = 0
+        with self._transaction() as connection:
+            for key in keys:
+                deleted += connection.execute("DELETE FROM session_entries WHERE key = ?", (key,)).rowcount > 0
+                connection.execute("DELETE FROM session_expiry WHERE key = ?", (key,))
+        return deleted
+
+    def _expire(self, key, seconds):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO session_expiry (key, expires_at) VALUES (?, ?)", (key, time.time() + seconds))
+        return True
+
+    async def rpush(self, key, *values):
+        return await asyncio.to_thread(self._rpush, key, values)
+
+    async def lrange(self, key, start, stop):
+        rows = await asyncio.to_thread(self._lrange, key)
+        return redis_range([value for value, in rows], start, stop)
+
+    async def delete(self, *keys):
+        return await asyncio.to_thread(self._delete, keys)
+
+    async def expire(self, key, seconds):
+        return await asyncio.to_thread(self._expire, key, seconds)
+
+def message_to_dict(message):
+    # Assistant messages from the OpenAI SDK are pydantic models; None fields (refusal, audio, ...) aren't stored
+    if not isinstance(message, dict):
+        message = message.model_dump(exclude_none=True)
+    return {key: value for key, value in message.items() if value is not None}
+
+def encode_message(message):
+    return json.dumps(message_to_dict(message), separators=(",", ":"), ensure_ascii=False)
+
+def decode_message(value):
+    return json.loads(value)
+
+class SessionStore:
+    def __init__(self, backend, ttl=SESSION_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    @staticmethod
+    def key(session_id, name):
+        return f"session:{session_id}:{name}"
+
+    # A failing backend never fails the turn: the error is logged and counted, a load returns an empty history, and a
+    # lost write only means the next turn sees less of the conversation.
+
+    @staticmethod
+    def failed(operation, e):
+        print(f"Session store {operation} failed: ", e)
+        metrics.increment(ERRORS_METRIC, operation=operation)
+
+    async def load(self, session_id, name):
+        try:
+            with metrics.span("session_store", operation="load"):
+                values = await self.backend.lrange(self.key(session_id, name), 0, -1)
+            return [decode_message(value) for value in values]
+        except Exception as e:
+            self.failed("load", e)
+            return []
+
+    async def append(self, session_id, name, messages):
+        if not messages:
+            return
+        key = self.key(session_id, name)
+        try:
+            with metrics.span("session_store", operation="append"):
+                await self.backend.rpush(key, *(encode_message(message) for message in messages))
+                await self.backend.expire(key, int(self.ttl))
+        except Exception as e:
+            self.failed("append", e)
+
+    async def replace(self, session_id, name, messages):
+        # For small derived histories that are rewritten every turn (e.g. app.py's trimmed planner history)
+        key = self.key(session_id, name)
+        try:
+            with metrics.span("session_store", operation="replace"):
+                await self.backend.delete(key)
+                if messages:
+                    await self.backend.rpush(key, *(encode_message(message) for message in messages))
+                    await self.backend.expire(key, int(self.ttl))
+        except Exception as e:
+            self.failed("replace", e)
+
+def open_backend(url=SESSION_STORE_URL):
+    if not url:
+        return MemoryBackend()
+    if url.startswith("sqlite://"):
+        return SQLiteBackend(url.removeprefix("sqlite://").removeprefix("/"))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        if redis is None:
+            raise RuntimeError("SESSION_STORE_URL points at Redis but the redis package isn't installed")
+        return redis.from_url(url)
+    raise ValueError(f"Unsupported SESSION_STORE_URL: {url}")
+
+def open_session_store():
+    # Falls back to in-process memory if the configured backend can't be opened
+    try:
+        backend = open_backend()
+    except (RuntimeError, ValueError, sqlite3.Error, OSError) as e:
+        print("Session store unavailable, keeping sessions in memory: ", e)
+        backend = MemoryBackend()
+    return SessionStore(backend)
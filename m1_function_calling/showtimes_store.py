@@ -0,0 +1,66 @@
+import re
+from cache import TTLCache
+from catalog import normalize_title
+
+# Parsed showtimes for every theater and day, keyed by (normalized title, normalized location). Follow-up questions like
+# "a later show" or "another theater" are answered by filtering the stored result instead of searching again.
+
+def normalize_location(location):
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", str(location).lower()).split())
+
+def parse_time(value):
+    # "7:30pm", "7:30 PM", "7pm" or "19:30" -> minutes since midnight, or None if it can't be parsed
+    match = re.match(r"^\s*(\d{1,2})(?::(\d{2}))?\s*([ap])?\.?\s*m?\.?\s*$", str(value).lower())
+    if not match:
+        return None
+
+    hour, minute, meridiem = int(match.group(1)), int(match.group(2) or 0), match.group(3)
+    if meridiem == "p" and hour < 12:
+        hour += 12
+    elif meridiem == "a" and hour == 12:
+        hour = 0
+    if hour > 23 or minute > 59:
+        return None
+    return hour * 60 + minute
+
+def filter_showtimes(showtimes, theater=None, after=None, day=None):
+    after_minutes = parse_time(after) if after else None
+    theater = normalize_location(theater) if theater else None
+    day = day.lower() if day else None
+
+    filtered = []
+    for showtime in showtimes:
+        if theater and theater not in normalize_location(showtime.theater):
+            continue
+        if day and day not in showtime.day.lower():
+            continue
+
+        times = showtime.times
+        if after_minutes is not None:
+            times = [time for time in times if (minutes := parse_time(time)) is None or minutes > after_minutes]
+            if not times:
+                continue
+        filtered.append(type(showtime)(showtime.theater, showtime.day, times))
+
+    return filtered
+
+class ShowtimesStore:
+    def __init__(self, ttl, maxsize=1024, l2=None, stale_ttl=0):
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize=maxsize, l2=l2, stale_ttl=stale_ttl)
+
+    @staticmethod
+    def key(title, location):
+        return (normalize_title(title), normalize_location(location))
+
+    def peek(self, title, location):
+        return self._cache.get(self.key(title, location))
+
+    async def get_or_fetch(self, title, location, fetch, serve_stale=False):
+        return await self._cache.get_or_fetch(self.key(title, location), fetch, self.ttl, serve_stale)
+
+    def warm(self):
+        return self._cache.warm()
+
+    def stats(self):
+        return self._cache.stats()
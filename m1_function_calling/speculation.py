@@ -0,0 +1,123 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import re
+from catalog import normalize_title
+import metrics
+from tool_registry import ToolError, recording_calls, record_call
+
+# Speculative tool calls: while the model is still deciding which tools to call, cheap keyword rules guess the likely
+# calls from the user's message and start them. If the model then requests a call with the same (canonical) arguments it
+# gets the speculative result, which hides the TMDb/SerpAPI latency behind the model's. Unused results are dropped at the
+# end of the turn, although the caches they filled stay warm. Tools with side effects are never speculated.
+
+SPECULATIVE_TOOLS = os.getenv("SPECULATIVE_TOOLS", "1") == "1"
+
+NEVER_SPECULATE = frozenset(("buy_ticket", "confirm_ticket_purchase"))
+
+NOW_PLAYING_PATTERN = re.compile(r"\b(playing|showing now|now showing|in theaters|in theatres|out now)\b")
+REVIEWS_PATTERN = re.compile(r"\b(reviews?|critics?|ratings?|rated|reception)\b")
+SHOWTIMES_PATTERN = re.compile(r"\b(showtimes?|show times?|showings?|screenings?|shows?)\b")
+ZIP_CODE_PATTERN = re.compile(r"\b(\d{5})\b")
+
+def guess_calls(message, catalog):
+    # Returns [(name, arguments, aliases)]; aliases are extra argument sets the model might use for the same call
+    text = normalize_title(message)
+    calls = []
+    if NOW_PLAYING_PATTERN.search(text):
+        calls.append(("get_now_playing_movies", {}, []))
+
+    movie = catalog.find_in_text(message)
+    if movie is None:
+        return calls
+
+    if REVIEWS_PATTERN.search(text):
+        calls.append(("get_reviews", {"movie": movie.title}, [{"movie": movie.id}]))
+    if SHOWTIMES_PATTERN.search(text) and (zip_code := ZIP_CODE_PATTERN.search(text)):
+        calls.append(("get_showtimes", {"title": movie.title, "location": zip_code.group(1)}, []))
+    return calls
+
+def canonical_value(value):
+    return normalize_title(value) if isinstance(value, str) else str(value)
+
+class Speculation:
+    def __init__(self, registry):
+        self.registry = registry
+        self._tasks = {} # (name, canonical arguments) -> task
+        self._arguments = {} # task -> arguments it was started with
+        self._used = set()
+
+    def key(self, name, arguments):
+        tool = self.registry.get(name)
+        if tool is None or tool.side_effects or name in NEVER_SPECULATE:
+            return None
+        try:
+            kwargs = tool.bind(arguments)
+        except ToolError:
+            return None
+        return name, tuple(sorted((key, canonical_value(value)) for key, value in kwargs.items()))
+
+    def start(self, message, catalog):
+        # Speculative calls mustn't show up in the turn's recorded calls unless the model actually asks for them
+        with recording_calls():
+            for name, arguments, aliases in guess_calls(message, catalog):
+                if (key := self.key(name, arguments)) is None or key in self._tasks:
+                    continue
+                print("Speculatively calling: ", name, arguments)
+                task = asyncio.create_task(self.registry.call(name, arguments), name=name)
+                self._tasks[key] = task
+                self._arguments[task] = arguments
+                for alias in aliases:
+                    if (alias_key := self.key(name, alias)) is not None:
+                        self._tasks.setdefault(alias_key, task)
+        return self
+
+    def take(self, name, arguments):
+        # An awaitable for the speculative result of this call, or None if it wasn't speculated
+        key = self.key(name, arguments)
+        task = self._tasks.get(key) if key else None
+        if task is None:
+            return None
+        self._used.add(task)
+        return self._result(name, arguments, task)
+
+    async def _result(self, name, arguments, task):
+        try:
+            result = await asyncio.shield(task)
+        except Exception as e:
+            # Possibly transient; make the call for real
+            print(f"Speculative {name} failed, calling it again: ", e)
+            return await self.registry.call(name, arguments)
+
+        metrics.increment("movies_speculative_calls_total", tool=name, result="used")
+        record_call(name, self.registry.get(name).bind(self._arguments[task]), result)
+        return result
+
+    def finish(self):
+        for task in set(self._tasks.values()) - self._used:
+            metrics.increment("movies_speculative_calls_total", tool=task.get_name(), result="wasted")
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception() # Retrieve it so a failed, unused call isn't logged as unhandled
+        self._tasks.clear()
+        self._arguments.clear()
+
+_current = contextvars.ContextVar("speculation", default=None)
+
+@contextlib.contextmanager
+def speculating(registry, message, catalog):
+    # Starts speculative calls for `message`; take() inside the block (including tasks it spawns) can claim their results
+    speculation = Speculation(registry).start(message, catalog) if SPECULATIVE_TOOLS and message else None
+    token = _current.set(speculation)
+    try:
+        yield speculation
+    finally:
+        _current.reset(token)
+        if speculation is not None:
+            speculation.finish()
+
+def take(name, arguments):
+    speculation = _current.get()
+    return speculation.take(name, arguments) if speculation is not None else None
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import time
+import metrics
+
+# Batches streamed tokens before sending them to the Chainlit UI, so a busy server sends one websocket frame per
+# window instead of one per token. The first token is sent immediately so time-to-first-token isn't delayed.
+# Also records time-to-first-token and inter-token gaps for the stream, which observe() exports as stage histograms.
+
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL_MS") or 30) / 1000
+STREAM_FLUSH_MAX_CHARS = int(os.getenv("STREAM_FLUSH_MAX_CHARS") or 64)
+
+class StreamCoalescer:
+    def __init__(self, message, interval=None, max_chars=None):
+        self.message = message
+        self.interval = STREAM_FLUSH_INTERVAL if interval is None else interval
+        self.max_chars = STREAM_FLUSH_MAX_CHARS if max_chars is None else max_chars
+        self._buffer = []
+        self._buffered_chars = 0
+        self._lock = asyncio.Lock()
+        self._timer = None
+        self._flush_task = None # Kept so the event loop doesn't drop a timer flush that's still running
+
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.last_token_at = None
+        self.tokens = 0
+        self.flushes = 0
+        self.max_gap = 0.0
+        self._total_gap = 0.0
+
+    # Same signature as cl.Message.stream_token, so the coalescer can be passed wherever a message is streamed to
+    async def stream_token(self, token):
+        if not token:
+            return
+
+        now = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        else:
+            gap = now - self.last_token_at
+            self._total_gap += gap
+            self.max_gap = max(self.max_gap, gap)
+        self.last_token_at = now
+        self.tokens += 1
+
+        self._buffer.append(token)
+        self._buffered_chars += len(token)
+
+        if self.flushes == 0 or self.interval <= 0 or self._buffered_chars >= self.max_chars:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # The lock keeps chunks in order when a timer flush and a size flush overlap
+        async with self._lock:
+            if not self._buffer:
+                return
+            chunk = "".join(self._buffer)
+            self._buffer.clear()
+            self._buffered_chars = 0
+            self.flushes += 1
+            await self.message.stream_token(chunk)
+
+    async def close(self):
+        await self.flush()
+
+    @property
+    def time_to_first_token(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def mean_gap(self):
+        return self._total_gap / (self.tokens - 1) if self.tokens > 1 else 0.0
+
+    def observe(self, **labels):
+        # Records the stream's ttft, token_gap_mean and token_gap_max alongside the pipeline's other stages
+        metrics.observe_duration("ttft", self.time_to_first_token, **labels)
+        if self.tokens > 1:
+            metrics.observe_duration("token_gap_mean", self.mean_gap, **labels)
+            metrics.observe_duration("token_gap_max", self.max_gap, **labels)
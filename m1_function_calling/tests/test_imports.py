@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+import pytest
+
+# Import smoke test: both apps (and the modules they pull in) must import cleanly with the default configuration, i.e.
+# with the persistent cache enabled at its default path. Each import runs in a fresh interpreter inside a temporary
+# directory so the cache file it creates doesn't touch the working tree.
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.mark.parametrize("module", ["movie_functions", "app", "app_using_openai"])
+def test_imports_with_default_environment(module, tmp_path):
+    environment = {
+        key: value for key, value in os.environ.items()
+        if key not in ("PERSISTENT_CACHE_PATH", "SESSION_STORE_URL", "METRICS_ENDPOINT")
+    }
+    environment["OPENAI_API_KEY"] = environment.get("OPENAI_API_KEY") or "test"
+    environment["PYTHONPATH"] = APP_DIR
+
+    result = subprocess.run(
+        # os._exit skips langfuse's exit-time flush, which waits on the network
+        [sys.executable, "-c", f"import os, {module}; os._exit(0)"],
+        cwd=tmp_path, env=environment, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    assert (tmp_path / ".cache" / "tool_cache.sqlite3").exists()
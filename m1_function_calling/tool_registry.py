@@ -0,0 +1,156 @@
+import contextlib
+import contextvars
+import inspect
+from collections import namedtuple
+import metrics
+
+# Declarative registry for the functions the assistant can call. Each function is registered once with typed parameters;
+# the OpenAI tool schemas (app_using_openai.py) and the prompt signatures (app.py) are generated from the registry, and both
+# apps dispatch through ToolRegistry.call().
+
+class ToolError(ValueError):
+    pass
+
+# Calls made through ToolRegistry.call() while recording_calls() is active, including ones made from tasks it spawns
+RecordedCall = namedtuple("RecordedCall", ["name", "arguments", "result", "failed"])
+_recorded_calls = contextvars.ContextVar("recorded_calls", default=None)
+
+@contextlib.contextmanager
+def recording_calls():
+    calls = []
+    token = _recorded_calls.set(calls)
+    try:
+        yield calls
+    finally:
+        _recorded_calls.reset(token)
+
+def record_call(name, arguments, result):
+    # For results obtained outside call() (e.g. a speculative call made earlier) that should still count as part of the turn
+    if (recorded := _recorded_calls.get()) is not None:
+        recorded.append(RecordedCall(name, arguments, result, False))
+
+class Parameter:
+    __slots__ = ("name", "type", "description", "required")
+
+    _converters = {"string": str, "integer": int, "number": float}
+
+    def __init__(self, name, description, type="string", required=True):
+        self.name = name
+        self.type = type
+        self.description = description
+        self.required = required
+
+    def convert(self, value):
+        try:
+            return self._converters[self.type](value)
+        except (TypeError, ValueError):
+            raise ToolError(f"Expected {self.type} for '{self.name}', got {value!r}")
+
+class Tool:
+    __slots__ = ("name", "description", "parameters", "parameter_names", "handler", "label", "is_async", "ttl", "side_effects")
+
+    def __init__(self, name, description, parameters, handler, label, ttl=None, side_effects=False):
+        self.name = name
+        self.description = description
+        self.parameters = tuple(parameters)
+        self.parameter_names = frozenset(parameter.name for parameter in self.parameters)
+        self.handler = handler
+        self.label = label
+        self.is_async = inspect.iscoroutinefunction(handler)
+        self.ttl = ttl # How long (seconds) a result stays fresh, if known
+        self.side_effects = side_effects # Results must never be reused or made speculatively
+
+    def schema(self):
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        parameter.name: {"type": parameter.type, "description": parameter.description}
+                        for parameter in self.parameters
+                    },
+                    "required": [parameter.name for parameter in self.parameters if parameter.required],
+                    "additionalProperties": False
+                }
+            }
+        }
+
+    def signature(self):
+        params = [parameter.name if parameter.required else f"[{parameter.name}]" for parameter in self.parameters]
+        return f"{self.name}({', '.join(params)})"
+
+    def bind(self, arguments, keywords=None):
+        # Accepts keyword arguments (a dict from OpenAI tool calls) or positional ones (a tuple from app.py's planner),
+        # optionally followed by keywords, which are matched to parameters by name
+        if not isinstance(arguments, dict):
+            if len(arguments) > len(self.parameters):
+                raise ToolError(f"{self.name} takes at most {len(self.parameters)} arguments, got {len(arguments)}")
+            arguments = {parameter.name: value for parameter, value in zip(self.parameters, arguments)}
+        if keywords:
+            if repeated := arguments.keys() & keywords.keys():
+                raise ToolError(f"{self.name} got multiple values for {', '.join(sorted(repeated))}")
+            arguments = {**arguments, **keywords}
+
+        if unexpected := arguments.keys() - self.parameter_names:
+            raise ToolError(f"Unexpected arguments for {self.name}: {', '.join(sorted(unexpected))}")
+
+        kwargs = {}
+        for parameter in self.parameters:
+            value = arguments.get(parameter.name)
+            if value is None or value == "":
+                if parameter.required:
+                    raise ToolError(f"Missing required argument '{parameter.name}' for {self.name}")
+                continue
+            kwargs[parameter.name] = parameter.convert(value)
+        return kwargs
+
+class ToolRegistry:
+    def __init__(self):
+        self._tools = {}
+
+    def __contains__(self, name):
+        return name in self._tools
+
+    def __iter__(self):
+        return iter(self._tools.values())
+
+    def get(self, name):
+        return self._tools.get(name)
+
+    def names(self):
+        return list(self._tools)
+
+    def register(self, name, description, parameters=(), label=None, ttl=None, side_effects=False):
+        def decorator(handler):
+            if name in self._tools:
+                raise ValueError(f"Tool '{name}' is already registered")
+            self._tools[name] = Tool(name, description, parameters, handler, label or name, ttl, side_effects)
+            return handler
+        return decorator
+
+    def openai_tools(self):
+        return [tool.schema() for tool in self._tools.values()]
+
+    def signatures(self):
+        return [tool.signature() for tool in self._tools.values()]
+
+    async def call(self, name, arguments=(), keywords=None):
+        recorded = _recorded_calls.get()
+        try:
+            tool = self._tools.get(name)
+            if tool is None:
+                raise ToolError(f"Unknown function '{name}'")
+            kwargs = tool.bind(arguments, keywords)
+            with metrics.span("tool_call", tool=name):
+                result = await tool.handler(**kwargs) if tool.is_async else tool.handler(**kwargs)
+        except BaseException:
+            if recorded is not None:
+                recorded.append(RecordedCall(name, arguments, None, True))
+            raise
+
+        if recorded is not None:
+            recorded.append(RecordedCall(name, kwargs, result, False))
+        return result
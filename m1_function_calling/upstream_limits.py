@@ -0,0 +1,272 @@
+import asyncio
+import contextvars
+import email.utils
+import os
+import random
+import time
+from collections import OrderedDict, deque
+import openai
+import metrics
+import load_shedding
+
+# Per-upstream backpressure for TMDb, SerpAPI and OpenAI. Each upstream gets a token bucket (sustained rate and burst), a
+# concurrency limit whose waiters are served round-robin per chat session, and retries with jittered exponential backoff
+# for 429s, 5xx and connection errors. A Retry-After from the upstream pauses the whole bucket, so every caller backs off
+# together instead of piling more requests onto a throttled API.
+#
+# Settings are read per upstream on first use, e.g. TMDB_RATE_LIMIT, TMDB_BURST, TMDB_MAX_CONCURRENCY and TMDB_MAX_RETRIES.
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+RETRY_BACKOFF_BASE = float(os.getenv("UPSTREAM_RETRY_BACKOFF_BASE") or 0.5)
+RETRY_BACKOFF_MAX = float(os.getenv("UPSTREAM_RETRY_BACKOFF_MAX") or 10)
+
+# upstream -> (requests per second (0 = unlimited), burst, max concurrent requests, max retries)
+DEFAULT_LIMITS = {
+    "tmdb": (40, 20, 20, 3),
+    "serpapi": (5, 5, 10, 2),
+    "openai": (0, 0, 64, 3),
+}
+
+# Set by the apps at the start of each turn, so queued requests can be interleaved fairly between chats
+current_session = contextvars.ContextVar("current_session", default=None)
+
+class RetryableError(Exception):
+    # Raised by a request function to ask for a retry, e.g. for a status code that isn't an exception in its client
+    def __init__(self, result, status_code=None, retry_after=None):
+        super().__init__(f"Retryable upstream response ({status_code})")
+        self.result = result
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    # "Full jitter" exponential backoff; a Retry-After from the upstream is a lower bound
+    delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, RETRY_BACKOFF_BASE)
+    return delay
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if self.rate <= 0:
+                return
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class FairSemaphore:
+    # A semaphore whose waiters are queued per session and woken round-robin across sessions, so one busy chat can't
+    # starve the others when the upstream is at capacity
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = OrderedDict() # session -> deque of futures
+
+    def waiting(self):
+        return sum(len(queue) for queue in self._waiters.values())
+
+    async def acquire(self, session=None):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._waiters.setdefault(session, deque())
+        queue.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as this waiter was cancelled; pass it on
+                self.release()
+            elif future in queue:
+                queue.remove(future)
+                if not queue and self._waiters.get(session) is queue:
+                    del self._waiters[session]
+            raise
+
+    def release(self):
+        while self._waiters:
+            session, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            if queue:
+                self._waiters.move_to_end(session)
+            else:
+                del self._waiters[session]
+            if not future.done():
+                future.set_result(None) # The slot passes directly to the waiter
+                return
+        self.active -= 1
+
+class UpstreamLimiter:
+    def __init__(self, name, rate, burst, concurrency, max_retries, retryable_exceptions=()):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.semaphore = FairSemaphore(concurrency)
+        self.max_retries = max_retries
+        self.retryable_exceptions = (RetryableError, *retryable_exceptions)
+
+    async def call(self, request, hold=None):
+        # request is a zero-argument function returning an awaitable; it's called again for every retry. If given,
+        # hold(result, release) takes over the concurrency slot and returns what the caller gets; it must call release()
+        # once the request is really finished (e.g. a streamed response has been read).
+        session = current_session.get()
+        attempt = 0
+        while True:
+            await self.semaphore.acquire(session)
+            held = False
+            try:
+                await self.bucket.acquire()
+                metrics.increment("movies_upstream_requests_total", upstream=self.name)
+                result = await request()
+                if hold is not None:
+                    result = hold(result, self.semaphore.release)
+                    held = True
+                return result
+            except self.retryable_exceptions as e:
+                error = e
+                status_code = getattr(e, "status_code", None)
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is None and (response := getattr(e, "response", None)) is not None:
+                    retry_after = parse_retry_after(response.headers.get("retry-after"))
+                metrics.increment("movies_upstream_retryable_total", upstream=self.name, status=status_code or "error")
+                if attempt >= self.max_retries:
+                    if isinstance(e, RetryableError):
+                        return e.result
+                    raise
+            finally:
+                if not held:
+                    self.semaphore.release()
+
+            if retry_after is not None:
+                # Throttled: hold back every request to this upstream, not just this one
+                self.bucket.pause(retry_after)
+            delay = backoff_delay(attempt, retry_after)
+            if (left := load_shedding.remaining()) is not None and delay >= left:
+                # The retry couldn't finish before the turn's deadline; fail now so the turn can fall back instead
+                load_shedding.record("retry_abandoned")
+                if isinstance(error, RetryableError):
+                    return error.result
+                raise error
+            print(f"{self.name} request failed ({status_code or type(error).__name__}); retrying in {delay:.2f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def send(self, request):
+        # For httpx requests: responses with a retryable status are retried, and the last one is returned if they all fail
+        async def checked_request():
+            response = await request()
+            if response.status_code in RETRY_STATUSES:
+                raise RetryableError(response, response.status_code, parse_retry_after(response.headers.get("retry-after")))
+            return response
+
+        return await self.call(checked_request)
+
+    def stats(self):
+        return {"active": self.semaphore.active, "waiting": self.semaphore.waiting()}
+
+_limiters = {}
+
+def _env(name, suffix, default, convert):
+    return convert(os.getenv(f"{name.upper()}_{suffix}") or default)
+
+def limiter(name, retryable_exceptions=()):
+    if (upstream := _limiters.get(name)) is None:
+        rate, burst, concurrency, retries = DEFAULT_LIMITS.get(name, (0, 0, 32, 2))
+        upstream = _limiters[name] = UpstreamLimiter(
+            name,
+            rate=_env(name, "RATE_LIMIT", rate, float),
+            burst=_env(name, "BURST", burst, int),
+            concurrency=_env(name, "MAX_CONCURRENCY", concurrency, int),
+            max_retries=_env(name, "MAX_RETRIES", retries, int),
+            retryable_exceptions=retryable_exceptions,
+        )
+        metrics.register_collector(lambda: {
+            (f"movies_upstream_{key}", (("upstream", name),)): value for key, value in upstream.stats().items()
+        })
+    return upstream
+
+class SlotHoldingStream:
+    # A streamed response that keeps its upstream concurrency slot until it's been read to the end, fails, or is closed.
+    # A stream that's dropped without being closed gives the slot back when it's garbage collected.
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def _finish(self):
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except BaseException: # The end of the stream (StopAsyncIteration), an error or cancellation
+            self._finish()
+            raise
+
+    async def close(self):
+        try:
+            if close := getattr(self._stream, "close", None):
+                await close()
+        finally:
+            self._finish()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    def __del__(self):
+        self._finish()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+OPENAI_RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+async def create_chat_completion(client, **kwargs):
+    # client.chat.completions.create() through the OpenAI limiter. Construct the client with max_retries=0 so that retries
+    # (and Retry-After pauses) are coordinated here rather than per request in the SDK. A streamed completion holds its
+    # slot until the stream is consumed or closed, so OPENAI_MAX_CONCURRENCY covers the whole response.
+    return await limiter("openai", OPENAI_RETRYABLE_ERRORS).call(
+        lambda: client.chat.completions.create(**kwargs),
+        hold=SlotHoldingStream if kwargs.get("stream") else None,
+    )